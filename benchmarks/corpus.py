@@ -0,0 +1,113 @@
+"""Generate synthetic document trees for the benchmarks
+
+Each corpus is a directory with an ``SConstruct`` building ``documents``
+Markdown files to HTML.  Every document has ``images`` images, uses a
+style sheet with a chain of ``includes`` nested imports, runs a chain of
+``filters`` JSON filters, and cites a bibliography with ``references``
+entries.
+
+"""
+import argparse
+import os
+import stat
+import textwrap
+
+CORPORA = {
+    "small": dict(documents=20, images=5, includes=2, filters=2,
+                  references=100),
+    "large": dict(documents=200, images=20, includes=4, filters=6,
+                  references=5000),
+}
+
+FILTER = '''\
+#!/usr/bin/env python3
+import json
+import sys
+
+json.dump(json.load(sys.stdin), sys.stdout)
+'''
+
+SCONSTRUCT = '''\
+import os
+
+env = Environment(ENV=os.environ, tools=["default", "pandoc"],
+                  PANDOC=ARGUMENTS.get("pandoc", "pandoc"))
+env.Append(PANDOCFLAGS=[{flags}])
+for doc in Glob("doc*.md"):
+    env.Pandoc(os.path.splitext(doc.name)[0] + ".html", doc)
+'''
+
+
+def generate(root, documents, images, includes, filters, references):
+    """Write a corpus to the directory ``root``"""
+    os.makedirs(os.path.join(root, "images"), exist_ok=True)
+    with open(os.path.join(root, "refs.bib"), "w") as stream:
+        for idx in range(references):
+            stream.write(textwrap.dedent("""\
+                @article{{ref{0},
+                  author = {{Author, A{0}}},
+                  title = {{Title {0}}},
+                  journal = {{Journal}},
+                  year = {{{1}}},
+                }}
+                """).format(idx, 1900 + idx % 120))
+
+    for idx in range(includes + 1):
+        with open(os.path.join(root, "style{0}.css".format(idx)), "w") \
+                as stream:
+            if idx < includes:
+                stream.write('@import "style{0}.css";\n'.format(idx + 1))
+
+            stream.write("p {{ margin: {0}px; }}\n".format(idx))
+
+    flags = ['"--css"', '"style0.css"', '"--citeproc"']
+    for idx in range(filters):
+        path = os.path.join(root, "filter{0}.py".format(idx))
+        with open(path, "w") as stream:
+            stream.write(FILTER)
+
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        flags.extend(['"--filter"', '"./filter{0}.py"'.format(idx)])
+
+    for idx in range(documents):
+        lines = ["---", "title: Document {0}".format(idx),
+                 "bibliography: refs.bib", "---", ""]
+        for img in range(images):
+            name = os.path.join("images", "doc{0}-{1}.png".format(idx, img))
+            with open(os.path.join(root, name), "wb") as stream:
+                stream.write(b"\x89PNG\r\n\x1a\n")
+
+            lines.extend([
+                    "# Section {0}".format(img), "",
+                    "Some text citing [@ref{0}].".format(
+                        (idx * images + img) % max(references, 1)
+                    ),
+                    "", "![Figure {0}]({1})".format(img, name), "",
+                ])
+
+        with open(os.path.join(root, "doc{0:04d}.md".format(idx)), "w") \
+                as stream:
+            stream.write("\n".join(lines))
+
+    with open(os.path.join(root, "SConstruct"), "w") as stream:
+        stream.write(SCONSTRUCT.format(flags=", ".join(flags)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="The directory to write")
+    parser.add_argument("--corpus", choices=sorted(CORPORA),
+                        default="small", help="The corpus to start from")
+    for name in CORPORA["small"]:
+        parser.add_argument("--" + name, type=int,
+                            help="Override the number of " + name)
+
+    args = parser.parse_args()
+    params = dict(CORPORA[args.corpus])
+    params.update((k, v) for k, v in vars(args).items()
+                  if k in params and v is not None)
+    generate(args.root, **params)
+
+
+if __name__ == "__main__":
+    main()
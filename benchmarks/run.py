@@ -0,0 +1,277 @@
+"""Time the scanner and the builder on a synthetic corpus
+
+The corpus from :mod:`corpus` is built with the tool in this repository
+and the stub Pandoc in ``stub`` unless another Pandoc is given.  The
+measurements are
+
+``scan``
+    A dry run of the whole tree with an empty scan cache.  The time in
+    the scanner is taken from the ``--pandoc-profile`` report.
+
+``cold-jN``
+    A full build from a clean tree with ``N`` jobs.
+
+``noop-jN``
+    The following build that has nothing to do.
+
+Each measurement has the wall time, the time in the scanner, and the
+peak resident set size of SCons.  The wall times depend on the machine
+so only their ratios are compared to the stored baseline: the share of
+each measurement spent in the scanner, the time of each cold build
+relative to the one with a single job, and the time of each no-op build
+relative to its cold build.  The run fails if any ratio, or the memory,
+exceeds the baseline by more than the threshold.  The baseline of a
+corpus is only used if it was stored with the same parameters.
+
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(os.path.dirname(ROOT), "sconscontrib", "SCons", "Tool",
+                    "pandoc")
+
+
+def scons(root, *args):
+    """Run SCons in ``root``
+
+    Returns
+    -------
+
+    seconds: float
+        The wall time of the run
+
+    rss: int or None
+        The peak resident set size in kilobytes if it is available
+
+    """
+    start = time.time()
+    proc = subprocess.Popen(
+            [sys.executable, "-m", "SCons", "-Q"] + list(args),
+            cwd=root, stdout=subprocess.DEVNULL
+        )
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) \
+            if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        rss = usage.ru_maxrss
+    except AttributeError:
+        proc.wait()
+        rss = None
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    return time.time() - start, rss
+
+
+def clean(root):
+    """Remove the outputs and the state of the previous build"""
+    for pattern in ("*.html", ".sconsign.dblite", ".pandocscan.json",
+                    "profile.json"):
+        for path in glob.glob(os.path.join(root, pattern)):
+            os.remove(path)
+
+
+def scanned(root):
+    """The time spent in the scanner from the profile report"""
+    with open(os.path.join(root, "profile.json")) as stream:
+        report = json.load(stream)
+
+    return sum(x["seconds"] for x in report["targets"])
+
+
+def measure(root, pandoc, jobs):
+    """Run the measurements on the corpus in ``root``"""
+    results = {}
+    site = os.path.join(root, "site_scons", "site_tools")
+    os.makedirs(site, exist_ok=True)
+    try:
+        os.symlink(TOOL, os.path.join(site, "pandoc"))
+    except (AttributeError, NotImplementedError, OSError):
+        shutil.copytree(TOOL, os.path.join(site, "pandoc"))
+
+    args = ["pandoc=" + pandoc, "--pandoc-profile=profile.json"]
+    clean(root)
+    seconds, rss = scons(root, "-n", *args)
+    results["scan"] = {"seconds": seconds, "scanner": scanned(root),
+                       "rss": rss}
+    for count in jobs:
+        clean(root)
+        seconds, rss = scons(root, "-j{0}".format(count), *args)
+        results["cold-j{0}".format(count)] = {
+                "seconds": seconds, "scanner": scanned(root), "rss": rss
+            }
+        os.remove(os.path.join(root, "profile.json"))
+        seconds, rss = scons(root, "-j{0}".format(count), *args)
+        results["noop-j{0}".format(count)] = {
+                "seconds": seconds, "scanner": scanned(root), "rss": rss
+            }
+
+    return results
+
+
+def ratios(results):
+    """The ratios of the measurements that do not depend on the machine
+
+    Each ratio is worse the higher it is.  The cold builds with more
+    jobs are given relative to the one with a single job, which is the
+    inverse of their speedup.
+
+    Returns
+    -------
+
+    ratios: dict
+        The ratios by name
+
+    """
+    result = {}
+    for name, value in results.items():
+        if value["seconds"]:
+            result[name + " scanner/seconds"] = \
+                value["scanner"] / value["seconds"]
+
+        kind, _, jobs = name.partition("-")
+        if kind == "cold" and jobs != "j1" and "cold-j1" in results:
+            result["{0}/cold-j1".format(name)] = \
+                value["seconds"] / results["cold-j1"]["seconds"]
+        elif kind == "noop" and "cold-" + jobs in results:
+            result["{0}/cold-{1}".format(name, jobs)] = \
+                value["seconds"] / results["cold-" + jobs]["seconds"]
+
+    return result
+
+
+def compare(results, baseline, threshold, slack):
+    """Find the measurements worse than the baseline
+
+    A ratio from :func:`ratios` regresses if it exceeds the baseline by
+    the factor ``threshold`` and by more than ``slack``.  The peak
+    memory regresses if it exceeds the baseline by the factor
+    ``threshold``.
+
+    Returns
+    -------
+
+    regressions: list
+        A message for each regression
+
+    """
+    regressions = []
+    base = ratios(baseline)
+    for name, value in ratios(results).items():
+        if name in base and value > base[name] * threshold and \
+                value - base[name] > slack:
+            regressions.append("{0}: {1:.3f} (baseline {2:.3f})".format(
+                    name, value, base[name]
+                ))
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        if result["rss"] and base.get("rss") and \
+                result["rss"] > base["rss"] * threshold:
+            regressions.append("{0} rss: {1} kB (baseline {2} kB)".format(
+                    name, result["rss"], base["rss"]
+                ))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", choices=sorted(corpus.CORPORA),
+                        default="small", help="The corpus to build")
+    for name in corpus.CORPORA["small"]:
+        parser.add_argument("--" + name, type=int,
+                            help="Override the number of " + name)
+
+    parser.add_argument("--jobs", default="1,4",
+                        help="Comma separated job counts (default 1,4)")
+    parser.add_argument("--pandoc",
+                        default=os.path.join(ROOT, "stub", "pandoc"),
+                        help="The Pandoc to use (default the stub)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Keep the fastest of this many runs")
+    parser.add_argument("--baseline",
+                        default=os.path.join(ROOT, "baseline.json"),
+                        help="The stored baseline")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="The allowed slowdown factor (default 1.25)")
+    parser.add_argument("--slack", type=float, default=0.05,
+                        help="Differences of a ratio below this are never "
+                        "regressions (default 0.05)")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store the results as the baseline")
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args()
+
+    params = dict(corpus.CORPORA[args.corpus])
+    params.update((k, v) for k, v in vars(args).items()
+                  if k in params and v is not None)
+    jobs = [int(x) for x in args.jobs.split(",")]
+    results = {}
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as root:
+            corpus.generate(root, **params)
+            for name, result in measure(root, args.pandoc, jobs).items():
+                if name not in results or \
+                        result["seconds"] < results[name]["seconds"]:
+                    results[name] = result
+
+    print("{0} corpus: {1}".format(args.corpus, ", ".join(
+            "{0}={1}".format(k, v) for k, v in params.items()
+        )))
+    for name, result in results.items():
+        print("{0:10s} {1:8.3f} s  scanner {2:8.3f} s  rss {3} kB".format(
+                name, result["seconds"], result["scanner"], result["rss"]
+            ))
+
+    for name, value in ratios(results).items():
+        print("{0:26s} {1:8.3f}".format(name, value))
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=1)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as stream:
+            baselines = json.load(stream)
+
+    if args.update_baseline:
+        baselines[args.corpus] = {"params": params, "results": results}
+        with open(args.baseline, "w") as stream:
+            json.dump(baselines, stream, indent=1, sort_keys=True)
+            stream.write("\n")
+
+        return 0
+
+    # A baseline of another corpus says nothing about this one.
+    baseline = baselines.get(args.corpus, {})
+    if baseline.get("params") != params:
+        print("No baseline for these {0} corpus parameters; not "
+              "comparing".format(args.corpus))
+        return 0
+
+    regressions = compare(results, baseline["results"], args.threshold,
+                          args.slack)
+    for message in regressions:
+        print("REGRESSION " + message)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
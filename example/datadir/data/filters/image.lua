@@ -0,0 +1,4 @@
+function Pandoc(doc)
+  doc.blocks:insert(pandoc.Para({pandoc.Image({}, "one.svg")}))
+  return doc
+end
@@ -0,0 +1,3 @@
+function Writer(doc, opts)
+  return pandoc.write(doc, "plain")
+end
@@ -0,0 +1,5 @@
+local helper = require "helper"
+
+function Header(elem)
+  return helper.demote(elem)
+end
@@ -0,0 +1,8 @@
+local helper = {}
+
+function helper.demote(elem)
+  elem.level = elem.level + 1
+  return elem
+end
+
+return helper
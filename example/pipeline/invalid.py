@@ -0,0 +1,8 @@
+"""A JSON filter that writes something else and hangs"""
+import sys
+import time
+
+sys.stdin.read()
+sys.stdout.write("not a syntax tree\n")
+sys.stdout.flush()
+time.sleep(30)
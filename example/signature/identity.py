@@ -0,0 +1,4 @@
+"""A JSON filter that changes nothing"""
+import sys
+
+sys.stdout.write(sys.stdin.read())
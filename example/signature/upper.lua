@@ -0,0 +1,3 @@
+function Str(elem)
+  return pandoc.Str(elem.text:upper())
+end
@@ -0,0 +1,8 @@
+"""A JSON filter that adds an image to the document"""
+import json
+import sys
+
+doc = json.load(sys.stdin)
+image = {"t": "Image", "c": [["", [], []], [], ["staged.svg", ""]]}
+doc["blocks"].append({"t": "Para", "c": [image]})
+json.dump(doc, sys.stdout)
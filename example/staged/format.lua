@@ -0,0 +1,5 @@
+-- Write the output format the filter sees into the document
+function Pandoc(doc)
+  doc.blocks:insert(pandoc.Para{pandoc.Str("FORMAT=" .. FORMAT)})
+  return doc
+end
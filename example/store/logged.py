@@ -0,0 +1,7 @@
+"""A JSON filter that changes nothing and logs each run"""
+import sys
+
+with open("logged.log", "a") as stream:
+    stream.write("run\n")
+
+sys.stdout.write(sys.stdin.read())
@@ -1,8 +1,12 @@
+import csv
 import filecmp
+import os
 import pathlib
 import re
 import shutil
+import signal
 import subprocess
+import threading
 
 import nox
 
@@ -11,25 +15,21 @@ import nox
 def flake8(session):
     """Run flake8"""
     session.install("flake8")
-    session.run("flake8", "sconscontrib", "noxfile.py")
+    session.run("flake8", "sconscontrib", "noxfile.py", "benchmarks")
 
 
 @nox.session(venv_backend="conda")
 @nox.parametrize(
     "python,scons", [
         (python, scons)
-        for python in ("3.6", "3.7", "3.8", "3.9")
+        for python in ("3.7", "3.8", "3.9")
         for scons in ("3.0.5", "3.1.2", "4.1.0.post1")
         if scons < "4" or python >= "3.9"
     ],
 )
-@nox.parametrize(
-    "panflute,pandoc", [("<2.0", ">=2.7,<2.10"), (">=2.0", ">2.10")]
-)
-def test(session, python, scons, panflute, pandoc):
-    session.install(f"scons=={scons}", f"panflute{panflute}",
-                    "import_metadata; python_version<'3.8'",
-                    )
+@nox.parametrize("pandoc", [">=2.7,<2.10", ">2.10"])
+def test(session, python, scons, pandoc):
+    session.install(f"scons=={scons}")
     session.conda_install(f"pandoc{pandoc}")
 
     root = pathlib.Path(__file__).parent
@@ -60,7 +60,7 @@ def test(session, python, scons, panflute, pandoc):
     session.install("numpy", "matplotlib")
 
     for src in root.joinpath("example").glob("*"):
-        if src.suffix in (".html", ".png"):
+        if src.is_dir() or src.suffix in (".html", ".png"):
             continue
 
         shutil.copy(src, dest)
@@ -85,3 +85,294 @@ def test(session, python, scons, panflute, pandoc):
     assert filecmp.cmp(root / "example" / f"example{tag}.html",
                        dest / "example.html",
                        shallow=False)
+
+
+def _example(session, name, pandoc="pandoc>=2.11"):
+    """Install the tool and copy an example to a scratch directory
+
+    Returns
+    -------
+
+    dest: pathlib.Path
+        The copy of the example, which is the working directory
+
+    """
+    session.install("scons")
+    session.conda_install(pandoc)
+    session.install(".[defaults]")
+
+    dest = pathlib.Path(session.create_tmp()).resolve() / name
+    if dest.is_dir():
+        shutil.rmtree(dest)
+
+    shutil.copytree(pathlib.Path(__file__).parent / "example" / name, dest)
+    session.chdir(dest)
+    return dest
+
+
+def _scons(session, *args, **kwargs):
+    """Run SCons in the example and return what it printed"""
+    return session.run("scons", "--no-site-dir", *args, external=False,
+                       silent=True, **kwargs)
+
+
+def _depends(session, *targets):
+    """The names in the dependency trees of the targets"""
+    tree = _scons(session, "--tree=prune", *targets)
+    return set(re.findall(r"\+-\[?([^\]\n]+)\]?$", tree, re.M))
+
+
+@nox.session(venv_backend="conda")
+def generated(session):
+    """Build a document whose source is made by the build"""
+    _example(session, "generated")
+    _scons(session)
+    # Everything made from the scan must be there after the first build
+    _scons(session, "--question")
+
+
+@nox.session(venv_backend="conda")
+def server(session):
+    """Build documents with a stand-in for the Pandoc server"""
+    dest = _example(session, "server", "pandoc")
+    _scons(session, "-j", "2")
+
+    # The bibliography was sent encoded and the slow conversion was left
+    # to the command line.
+    assert (dest / "server.html").read_text() == \
+        "stand-in\nserver.bib: True\n"
+    assert not (dest / "slow.html").read_text().startswith("stand-in")
+
+
+@nox.session(venv_backend="conda")
+def defaults(session):
+    """Scan a document with the settings of a defaults file"""
+    _example(session, "defaults")
+    _scons(session)
+
+    # The settings without an option of the same name reach Pandoc and
+    # the files they name are dependencies.
+    depends = _depends(session, "defaults.html")
+    for name in ("defaults.yaml", "defaults.bib",
+                 os.path.join("figures", "figure.svg")):
+        assert name in depends, name
+
+
+@nox.session(venv_backend="conda")
+@nox.parametrize("engine", ["threads", "asyncio"])
+def pipeline(session, engine):
+    """Report the failed stage of a scan pipeline"""
+    dest = _example(session, "pipeline")
+    output = _scons(session, "-k", "engine=" + engine, success_codes=[2])
+    assert "stage 'missing-filter' could not be started" in output
+    assert "stage 'invalid.py' wrote an invalid syntax tree" in output
+    assert "exit status" not in output
+    assert (dest / "identity.html").is_file()
+    assert {"identity.py", "pipeline.svg"} <= _depends(
+            session, "engine=" + engine, "identity.html"
+        )
+
+
+@nox.session(venv_backend="conda")
+def staged(session):
+    """Run only the stages of a filter chain after a change"""
+    dest = _example(session, "staged")
+    _scons(session)
+    assert "FORMAT=html" in (dest / "staged.html").read_text()
+    assert "staged.svg" in _depends(session, "staged.html")
+
+    # Neither the build nor the scan of the output runs the first filter
+    # again.
+    with open(dest / "filter1.py", "a") as stream:
+        stream.write("# Edited\n")
+
+    _scons(session)
+    assert (dest / "filter0.log").read_text() == "run\n"
+
+
+@nox.session(venv_backend="conda")
+def fastpath(session):
+    """Verify the Markdown fast path against Pandoc on its edge cases"""
+    dest = _example(session, "fastpath")
+    _scons(session, "fast=auto")
+
+    # The verifying scan must run Pandoc, not reuse the result of the
+    # fast path from the scan cache.
+    (dest / "fastpath.html").unlink()
+    output = _scons(session, "--pandoc-profile=profile.csv")
+    assert "Markdown fast scan" not in output
+    with open(dest / "profile.csv") as stream:
+        record, = csv.DictReader(stream)
+
+    assert record["cached"] == "0" and record["processes"] == "1"
+
+    depends = _depends(session, "fastpath.html")
+    assert {"inline.svg", "reference.svg", "shortcut.svg"} <= depends
+    for name in ("code", "escaped", "fence", "math", "html"):
+        assert name + ".svg" not in depends, name
+
+
+@nox.session(venv_backend="conda")
+def signature(session):
+    """Rebuild only for the changes a normalized signature keeps"""
+    _example(session, "signature")
+    _scons(session, "flags=--standalone --toc --filter identity.py "
+                    "--lua-filter upper.lua")
+
+    # Reordered independent flags and --output= are the same command.
+    _scons(session, "--question", "output=long",
+           "flags=--toc --filter identity.py --standalone "
+           "--lua-filter upper.lua")
+
+    # Filters run in the order given.
+    _scons(session, "--question",
+           "flags=--standalone --toc --lua-filter upper.lua "
+           "--filter identity.py", success_codes=[1])
+
+
+@nox.session(venv_backend="conda")
+def formats(session):
+    """Report an unknown format before running the scan"""
+    dest = _example(session, "formats")
+    output = _scons(session, "-k", success_codes=[2])
+    assert "does not support the input format 'mardown'" in output
+    assert (dest / "extensions.html").is_file()
+    assert (dest / "custom.txt").is_file()
+
+
+@nox.session(venv_backend="conda")
+def log(session):
+    """Leave the log of the build to the build"""
+    dest = _example(session, "log")
+    _scons(session, "--dry-run")
+    assert not (dest / "log.json").exists()
+    assert "log.svg" in _depends(session, "log.html")
+    assert (dest / "log.json").is_file()
+
+
+@nox.session(venv_backend="conda")
+def datadir(session):
+    """Scan again after a change to a Lua filter in the data directory"""
+    dest = _example(session, "datadir")
+    assert "one.svg" in _depends(session, "datadir.html")
+
+    script = dest / "data" / "filters" / "image.lua"
+    script.write_text(script.read_text().replace("one.svg", "two.svg"))
+    depends = _depends(session, "datadir.html")
+    assert "two.svg" in depends and "one.svg" not in depends
+
+
+@nox.session(venv_backend="conda")
+@nox.parametrize("engine", ["threads", "asyncio"])
+def prescan(session, engine):
+    """Scan the documents of a build concurrently"""
+    dest = _example(session, "prescan")
+    _scons(session, "--dry-run", "engine=" + engine)
+    assert (dest / "rendezvous.log").read_text() == "together\n" * 2
+    assert "first.svg" in _depends(session, "engine=" + engine,
+                                   "first.html")
+
+
+@nox.session(venv_backend="conda")
+def tokenizer(session):
+    """Scan a command with combined, attached, and '=' option values"""
+    _example(session, "tokenizer")
+    depends = _depends(session, "tokenizer.html")
+    for name in ("filter.py", "style.css", "refs.bib", "filtered.svg"):
+        assert name in depends, name
+
+
+@nox.session(venv_backend="conda")
+def includes(session):
+    """Scan the files referred to by included files and resource paths"""
+    dest = _example(session, "includes")
+    depends = _depends(session, "includes.html")
+    for name in ("base.css", "background.svg", "extra.css", "helper.lua",
+                 "refs.bib", os.path.join("figures", "figure.svg")):
+        assert name in depends, name
+
+    # A change to a nested file rebuilds the document.
+    with open(dest / "base.css", "a") as stream:
+        stream.write("/* Edited */\n")
+
+    _scons(session, "--question", success_codes=[1])
+
+
+@nox.session(venv_backend="conda")
+def emitter(session):
+    """Clean and cache the outputs Pandoc writes beside the targets"""
+    dest = _example(session, "emitter", "pandoc>=3")
+    _scons(session, "-j", "3")
+    for name in ("logged.json", "book/index.html", "book/sitemap.json",
+                 "media/emitter.svg"):
+        assert (dest / name).is_file(), name
+
+    _scons(session, "--clean")
+    for name in ("logged.json", "book", "media"):
+        assert not (dest / name).exists(), name
+
+    # The log comes back with its document while the directories SCons
+    # only partly knows are built again.
+    output = _scons(session)
+    assert "Retrieved `logged.json' from cache" in output
+    assert "Retrieved `book" not in output
+    assert (dest / "media" / "emitter.svg").is_file()
+
+
+@nox.session(venv_backend="conda")
+def store(session):
+    """Take the scans of a fresh build from the scan store"""
+    dest = _example(session, "store")
+    _scons(session, "--dry-run")
+    output = _scons(session, "--dry-run", "--cache-debug=-")
+    assert "1 hits" in output
+    assert (dest / "logged.log").read_text() == "run\n"
+
+    _scons(session, "--dry-run", "--cache-disable")
+    assert (dest / "logged.log").read_text() == "run\n" * 2
+
+
+@nox.session(venv_backend="conda")
+@nox.parametrize("backend", ["inotify", "poll"])
+def watch(session, backend):
+    """Rebuild only the documents depending on a changed file"""
+    dest = _example(session, "watch")
+    proc = subprocess.Popen(
+            ["scons", "--no-site-dir", "--pandoc-watch", "backend=" + backend],
+            env=dict(os.environ, PATH=os.pathsep.join([
+                session.bin, os.environ["PATH"]
+            ])),
+            stdout=subprocess.PIPE, universal_newlines=True
+        )
+    # A watch that hangs is killed so the session fails.
+    timer = threading.Timer(120, proc.kill)
+    timer.start()
+
+    def watching():
+        """Wait for the build before the watch starts"""
+        return any(x.startswith("scons: watching") for x in proc.stdout)
+
+    try:
+        assert watching()
+        first = (dest / "first.html").stat().st_mtime_ns
+        second = (dest / "second.html").stat().st_mtime_ns
+        with open(dest / "first.svg", "a") as stream:
+            stream.write("<!-- Edited -->\n")
+
+        assert watching()
+        assert (dest / "first.html").stat().st_mtime_ns > first
+        assert (dest / "second.html").stat().st_mtime_ns == second
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait()
+        timer.cancel()
+
+    assert proc.returncode == 0
+
+
+@nox.session
+def benchmark(session):
+    """Time the scanner and the builder against the stored baseline"""
+    session.install("scons")
+    session.chdir(pathlib.Path(__file__).parent / "benchmarks")
+    session.run("python", "run.py", *session.posargs)
@@ -36,33 +36,57 @@ method.
 
 import SCons.Action
 import SCons.Builder
+import SCons.Defaults
+import SCons.Errors
+import SCons.Node
+import SCons.Node.FS
 import SCons.Scanner
+import SCons.Script
+import SCons.SConsign
+import SCons.Taskmaster
 import SCons.Util
 try:
     from SCons.Warnings import SConsWarning as SConsWarning
 except ImportError:
     from SCons.Warnings import Warning as SConsWarning
 
-import argparse
+try:
+    import SCons.Taskmaster.Job as _jobs
+except ImportError:
+    import SCons.Job as _jobs
+
+import atexit
+import base64
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import csv
+import functools
+import hashlib
+import io
+import json
 import logging
+import optparse
 import os
 import re
+import select
 import shlex
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-try:
-    import importlib.metadata as metadata
-except ImportError:
-    # Work around the fact that mypy has a bug
-    #
-    # -   https://github.com/python/mypy/issues/1153
-    import importlib_metadata as metadata  # type: ignore
+# The asyncio scan engine and the Pandoc server import asyncio and
+# urllib.request when they run because these are slow to import.
 
 if sys.version_info < (3, 6):
-    raise RuntimeError(
-        "Panflute (and thus this Tool) does not support Python < 3.6"
-    )
+    raise RuntimeError("This Tool does not support Python < 3.6")
 
 __version__ = "1.2.0"
 
@@ -116,9 +140,332 @@ class PanflutePandocVersionSkew(ToolPandocWarning):
     pass
 
 
+class PandocServerWarning(ToolPandocWarning):
+    pass
+
+
+class PyYAMLNotFound(ToolPandocWarning):
+    pass
+
+
+class PandocFastScanMismatch(ToolPandocWarning):
+    pass
+
+
 SCons.Warnings.enableWarningClass(ToolPandocWarning)
 
 
+class _Profile(object):
+    """The cost of scanning each target
+
+    The profile is enabled by giving the report file with the
+    ``--pandoc-profile`` option or ``$PANDOCPROFILE``.  The costs are
+    added to the record of the target the current thread or task is
+    scanning and the report is written at the end of the build.  A
+    report ending in '.csv' has a row per target; otherwise, it is JSON
+    and also has the time spent in each stage of the pipelines.
+
+    """
+    fields = ("target", "scans", "cached", "stored", "fast", "seconds",
+              "plan_seconds", "filter_lookup_seconds", "processes", "bytes",
+              "extract_seconds")
+
+    def __init__(self):
+        self.path = None
+        self.records = collections.OrderedDict()
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar("record", default=None)
+
+    def enable(self, env):
+        """Enable the profile if the user asked for it"""
+        if self.path is None:
+            path = SCons.Script.GetOption("pandoc_profile") \
+                or env.subst("$PANDOCPROFILE")
+            self.path = env.File(path).abspath if path else ""
+
+        return bool(self.path)
+
+    @contextlib.contextmanager
+    def target(self, node):
+        """Add the costs in the block to the record of ``node``"""
+        if not self.path:
+            yield
+            return
+
+        with self.lock:
+            record = self.records.get(str(node))
+            if record is None:
+                record = dict.fromkeys(self.fields, 0)
+                record["target"] = str(node)
+                record["stages"] = {}
+                self.records[str(node)] = record
+
+        token = self.current.set(record)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add("seconds", time.time() - start)
+            self.current.reset(token)
+
+    @contextlib.contextmanager
+    def timer(self, field):
+        """Add the time spent in the block to ``field``"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(field, time.time() - start)
+
+    def add(self, field, value=1):
+        """Add to a field of the current record"""
+        record = self.current.get()
+        if record is not None:
+            with self.lock:
+                record[field] += value
+
+    def stage(self, name, seconds):
+        """Add the run time of a process in a scan pipeline"""
+        if not self.path:
+            return
+
+        record = self.current.get()
+        with self.lock:
+            total = self.stages.setdefault(name, {"runs": 0, "seconds": 0.0})
+            total["runs"] += 1
+            total["seconds"] += seconds
+            if record is not None:
+                record["stages"][name] = \
+                    record["stages"].get(name, 0.0) + seconds
+
+    def counted(self, stream):
+        """Wrap a binary stream to add the bytes read to the record"""
+        profile = self
+
+        class Counted(io.RawIOBase):
+            def readable(self):
+                return True
+
+            def readinto(self, buf):
+                count = stream.readinto(buf)
+                profile.add("bytes", count or 0)
+                return count
+
+        return io.BufferedReader(Counted())
+
+    def save(self):
+        """Write the report"""
+        if not self.path or not self.records:
+            return
+
+        records = sorted(self.records.values(), key=lambda x: -x["seconds"])
+        with open(self.path, "w", newline="") as stream:
+            if self.path.endswith(".csv"):
+                writer = csv.DictWriter(stream, self.fields,
+                                        extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                json.dump({"targets": records, "stages": self.stages},
+                          stream, indent=1)
+
+
+_profile = _Profile()
+atexit.register(_profile.save)
+
+
+# The long name of each short option and alias of a Pandoc option.
+_aliases = {
+        "-f": "--from", "-r": "--from", "--read": "--from",
+        "-t": "--to", "-w": "--to", "--write": "--to",
+        "-o": "--output", "-d": "--defaults", "-M": "--metadata",
+        "-V": "--variable", "-F": "--filter", "-L": "--lua-filter",
+        "-H": "--include-in-header", "-B": "--include-before-body",
+        "-A": "--include-after-body", "-c": "--css",
+        "-T": "--title-prefix", "-D": "--print-default-template",
+        "-s": "--standalone", "-C": "--citeproc",
+        "-N": "--number-sections", "-p": "--preserve-tabs",
+        "-i": "--incremental", "-h": "--help", "-v": "--version",
+        "--table-of-contents": "--toc",
+    }
+
+# The options that require a value.  Every other option only takes an
+# optional value given with '='.
+_valued = frozenset([
+        "--abbreviations", "--base-header-level", "--bibliography",
+        "--chunk-template", "--citation-abbreviations", "--columns",
+        "--css", "--csl", "--data-dir", "--default-image-extension",
+        "--defaults", "--dpi", "--email-obfuscation", "--eol",
+        "--epub-chapter-level", "--epub-cover-image",
+        "--epub-embed-font", "--epub-metadata", "--epub-subdirectory",
+        "--extract-media", "--filter", "--from", "--highlight-style",
+        "--id-prefix", "--include-after-body", "--include-before-body",
+        "--include-in-header", "--indented-code-classes",
+        "--ipynb-output", "--log", "--lua-filter", "--markdown-headings",
+        "--metadata", "--metadata-file", "--number-offset", "--output",
+        "--pdf-engine", "--pdf-engine-opt", "--print-default-template",
+        "--print-highlight-style", "--reference-doc",
+        "--reference-location", "--request-header", "--resource-path",
+        "--shift-heading-level-by", "--slide-level", "--split-level",
+        "--syntax-definition", "--tab-stop", "--template",
+        "--title-prefix", "--to", "--toc-depth", "--top-level-division",
+        "--track-changes", "--variable", "--variable-json", "--wrap",
+    ])
+
+_Option = collections.namedtuple("_Option", ["name", "value", "args"])
+
+
+def _tokenize(args):
+    """Split Pandoc command line arguments into options
+
+    The ``--flag=value``, ``--flag value``, ``-Xvalue``, and ``-X
+    value`` forms are recognized along with combined short flags like
+    ``-sC``.  Everything after ``--`` is an input.
+
+    Returns
+    -------
+
+    options: list
+        An :class:`_Option` for each option and input in order with the
+        long ``name`` of the option or None for an input, its ``value``
+        or None, and the tuple of ``args`` giving it
+
+    """
+    result = []
+    args = list(args)
+    while args:
+        item = args.pop(0)
+        if item == "--":
+            result.extend(_Option(None, x, (x,)) for x in args)
+            break
+
+        if not item.startswith("-") or item == "-":
+            result.append(_Option(None, item, (item,)))
+        elif item.startswith("--"):
+            name, eq, value = item.partition("=")
+            name = _aliases.get(name, name)
+            if eq:
+                result.append(_Option(name, value, (item,)))
+            elif name in _valued and args:
+                value = args.pop(0)
+                result.append(_Option(name, value, (item, value)))
+            else:
+                result.append(_Option(name, None, (item,)))
+        else:
+            # Short flags may be combined and the last may have a value.
+            for idx in range(1, len(item)):
+                flag = "-" + item[idx]
+                name = _aliases.get(flag, flag)
+                if name not in _valued:
+                    result.append(_Option(name, None, (flag,)))
+                elif idx + 1 < len(item):
+                    value = item[idx + 1:]
+                    result.append(_Option(name, value, (flag + value,)))
+                    break
+                elif args:
+                    value = args.pop(0)
+                    result.append(_Option(name, value, (flag, value)))
+                else:
+                    result.append(_Option(name, None, (flag,)))
+
+    return result
+
+
+@functools.lru_cache(maxsize=256)
+def _command_line(command):
+    """Parse a Pandoc command with :func:`_tokenize`
+
+    The parsed commands are kept so the targets sharing the same flags
+    parse them once.
+
+    Returns
+    -------
+
+    options: tuple
+        The :class:`_Option` of each argument of the command
+
+    """
+    return tuple(_tokenize(shlex.split(command)))
+
+
+# The options Pandoc runs in the order they are given.
+_ordered = frozenset(["--filter", "--lua-filter", "--citeproc"])
+
+# The options that add to a list instead of replacing the value.
+_repeated = frozenset([
+        "--bibliography", "--css", "--epub-embed-font",
+        "--include-after-body", "--include-before-body",
+        "--include-in-header", "--metadata", "--metadata-file",
+        "--pdf-engine-opt", "--request-header", "--syntax-definition",
+        "--variable", "--variable-json",
+    ])
+
+
+def _signature(cmd):
+    """The canonical form of a Pandoc command line
+
+    Every option is given with its long name and an ``=``, the options
+    are sorted, and the last value of an option that does not add to a
+    list wins.  The filters keep their order as do the values of a list
+    option and the inputs.  The executable is reduced to its name as the
+    contents of Pandoc are a dependency of every document.
+
+    Returns
+    -------
+
+    signature: list or None
+        The arguments or None if the command uses a defaults file whose
+        options depend on their position
+
+    """
+    options = _tokenize(cmd[1:])
+    if any(x.name == "--defaults" for x in options):
+        return None
+
+    filters = []
+    lists = collections.defaultdict(list)
+    values = {}
+    for option in options:
+        if option.name is None:
+            continue
+
+        value = option.value
+        if option.name not in _valued and value in (None, "true"):
+            flag = option.name
+        else:
+            flag = "{0}={1}".format(option.name, value or "")
+
+        if option.name in _ordered:
+            filters.append(flag)
+        elif option.name in _repeated:
+            lists[option.name].append(flag)
+        else:
+            values[option.name] = flag
+
+    def key(flag):
+        # Repeated metadata and variables only keep their order with
+        # the same key.
+        return re.split("[=:]", flag.partition("=")[2], maxsplit=1)[0]
+
+    for name in ("--metadata", "--variable", "--variable-json"):
+        lists[name].sort(key=key)
+
+    result = [os.path.basename(cmd[0])] if cmd else []
+    for name in sorted(set(values) | set(lists)):
+        result.extend(lists[name] if name in lists else [values[name]])
+
+    return result + filters + ["--"] + [
+            x.value for x in options if x.name is None
+        ]
+
+
+def _values(options, name):
+    """The values of every instance of an option in order"""
+    return [x.value for x in options
+            if x.name == name and x.value is not None]
+
+
 def _find_filter(filt, datadir, env):
     """Utility function to determine the Pandoc filter command
 
@@ -126,8 +473,8 @@ def _find_filter(filt, datadir, env):
     we need to pass it through an interpreter.  According to the User's
     Guide, the search order is: full or relative path to the filter, in
     the $DATADIR/filters directory, and finally in the $PATH.  If the
-    datadir provided is None, we check the ``pandoc --version`` output
-    for the default.  The ``env`` is the SCons construction Environment.
+    datadir provided is None, we use the default reported by
+    :func:`_probe`.  The ``env`` is the SCons construction Environment.
 
     Returns
     -------
@@ -137,18 +484,11 @@ def _find_filter(filt, datadir, env):
 
     """
     if not datadir:
-        output = subprocess.check_output([env["PANDOC"], "--version"],
-                                         universal_newlines=True)
-        for line in output.split("\n"):
-            pattern = r"\s*Default user data directory:\s*(.*)"
-            match = re.match(pattern, line)
-            if match:
-                datadir = match.group(1)
-                break
+        datadir = _probe(env).datadir
 
     if os.path.exists(filt):
         cmd = [filt]
-    elif datadir and os.path.exists(os.path.join(datadir, filt)):
+    elif datadir and os.path.exists(os.path.join(datadir, "filters", filt)):
         cmd = [os.path.join(datadir, "filters", filt)]
     else:
         # The filter must be executable and on the PATH.  Therefore, we
@@ -175,367 +515,4279 @@ def _find_filter(filt, datadir, env):
     return interpreter.get(ext, []) + cmd
 
 
-def _detect(env):
-    """Try to find Pandoc and :package:`panflute`
+def _find_defaults(name, datadir, env, search=True):
+    """Locate a defaults file given with ``--defaults``
+
+    Like Pandoc, the '.yaml' extension is added if there is none and
+    the file is looked for as given and then in the $DATADIR/defaults
+    directory.  If the datadir provided is None, we use the default
+    reported by :func:`_probe`.  The data directory is not searched if
+    ``search`` is False.
+
+    Returns
+    -------
+
+    path: str or None
+        The path to the file or None if it is not found
+
     """
-    try:
-        return env["PANDOC"]
-    except KeyError:
-        pass
+    if not os.path.splitext(name)[1]:
+        name = name + ".yaml"
 
-    pandoc = env.WhereIs("pandoc")
-    if pandoc:
-        return pandoc
+    if os.path.exists(name):
+        return name
 
-    raise SCons.Errors.StopError(
-            PandocNotFound, "Could not find Pandoc"
-        )
+    if not search:
+        return None
 
+    if not datadir:
+        datadir = _probe(env).datadir
 
-def _scanner(node, env, path, arg=None):
-    """ Attempt to scan the final target for images and bibliographies
+    path = os.path.join(datadir or "", "defaults", name)
+    return path if datadir and os.path.exists(path) else None
 
-    In Pandoc flavored MarkDown, the only "included" files are the
-    images and the bibliographies.  We need to tell SCons about these,
-    but we don't want to do this by hand.  To do this, we directly use
-    Pandoc's json output and analyze the document tree for the images
-    and the metadata for bibliographies.  We need to operate on the
-    filtered syntax tree so we can get the final filtered version.  The
-    logic should work on any input format Pandoc can translate into its
-    AST.
 
-    Note you must respect Pandoc's bibliography file rules.  The command
-    line arguments will override files specified in the YAML block of
-    the header file.
+# The option for each key of a defaults file that matters to the scan
+# or names a file the target depends on.  The filters, metadata,
+# variables, request headers, resource path, and citation method are
+# translated by :func:`_load_defaults`, and the other keys are dropped
+# as Pandoc either has no option for them or they only change the
+# writer.
+_defaults_keys = {
+        "from": "--from",
+        "reader": "--from",
+        "to": "--to",
+        "writer": "--to",
+        "output-file": "--output",
+        "data-dir": "--data-dir",
+        "log-file": "--log",
+        "sandbox": "--sandbox",
+        "shift-heading-level-by": "--shift-heading-level-by",
+        "indented-code-classes": "--indented-code-classes",
+        "default-image-extension": "--default-image-extension",
+        "file-scope": "--file-scope",
+        "metadata": "--metadata",
+        "metadata-file": "--metadata-file",
+        "metadata-files": "--metadata-file",
+        "preserve-tabs": "--preserve-tabs",
+        "tab-stop": "--tab-stop",
+        "track-changes": "--track-changes",
+        "extract-media": "--extract-media",
+        "abbreviations": "--abbreviations",
+        "standalone": "--standalone",
+        "template": "--template",
+        "variables": "--variable",
+        "toc": "--toc",
+        "table-of-contents": "--toc",
+        "toc-depth": "--toc-depth",
+        "number-sections": "--number-sections",
+        "identifier-prefix": "--id-prefix",
+        "title-prefix": "--title-prefix",
+        "include-in-header": "--include-in-header",
+        "include-before-body": "--include-before-body",
+        "include-after-body": "--include-after-body",
+        "css": "--css",
+        "reference-doc": "--reference-doc",
+        "highlight-style": "--highlight-style",
+        "syntax-definition": "--syntax-definition",
+        "syntax-definitions": "--syntax-definition",
+        "epub-cover-image": "--epub-cover-image",
+        "epub-metadata": "--epub-metadata",
+        "epub-fonts": "--epub-embed-font",
+        "bibliography": "--bibliography",
+        "csl": "--csl",
+        "citation-abbreviations": "--citation-abbreviations",
+        "pdf-engine-opts": "--pdf-engine-opt",
+        "pdf-engine-opt": "--pdf-engine-opt",
+        "request-headers": "--request-header",
+        "no-check-certificate": "--no-check-certificate",
+        "resource-path": "--resource-path",
+        "filters": None,
+        "cite-method": None,
+    }
 
-    This logic is primarily aimed at the MarkDown sources, but it should
-    work with the other plain text sources too.  However, this is not
-    rigorously tested.  For LaTeX sources, you should really just use
-    the SCons builder to have the right thing done.
+# The parsed defaults files keyed on the path along with the
+# modification time and size when they were read.
+_defaults = {}
+_yaml_warned = False
+
+
+def _load_defaults(path, datadir):
+    """Read a defaults file into command line options
+
+    The file is read once per build unless it changes.  The settings
+    are translated to the equivalent options with the ``${.}``,
+    ``${USERDATA}``, and environment variables in paths expanded.
+
+    Returns
+    -------
+
+    defaults: list or None
+        The defaults files the file inherits
+
+    options: list or None
+        The :class:`_Option` for each setting or None if
+        :package:`PyYAML` is not available
 
     """
-    import panflute
-    logger = logging.getLogger(__name__ + ".scanner")
-    # Grab the base command SCons will run and remove the output flag.
-    # This does assume the user did not override the command variable
-    # and hard code the output.
-    cmd = shlex.split(env.subst_target_source("$PANDOCCOM"))
-    for flag in ("-o", "--output"):
-        try:
-            cmd.remove(flag)
-        except ValueError:
-            # They specified the other flag
-            pass
+    global _yaml_warned
+    try:
+        import yaml
+    except ImportError:
+        if not _yaml_warned:
+            _yaml_warned = True
+            SCons.Warnings.warn(
+                    PyYAMLNotFound,
+                    "Could not find PyYAML to read the Pandoc defaults files"
+                )
 
-    # If the user provided the --from flag, we need to move it to the
-    # beginning of the command
-    newidx = 1
-    for idx, item in enumerate(cmd):
-        match = re.match(r"(-f|--from=?)([-+\w]*)?", item)
-        if match:
-            cmd[newidx:newidx] = [cmd.pop(idx)]
-            newidx += 1
-            if not match.group(2):
-                cmd[newidx:newidx] = [cmd.pop(idx+1)]
-                newidx += 1
-
-    logger.debug("initial command: '{0}'".format(" ".join(cmd)))
-    # Now parse the command line for the known arguments with files that
-    # are needed generate the final document.  But, we want to make sure
-    # the file is actually in the build tree and not simply an installed
-    # executable or file.  To do this, we map destinations in an
-    # :class:`argparser.ArgumentParser` to Pandoc flags.  We do not want
-    # to deal with searching all over creation so we do not deal with
-    # the data directory.
-    #
-    # .. note:: This does not deal with the --resource-path flag which
-    #           provides additional search paths for Pandoc.
-    arguments = {
-            "filter": ("-F", "--filter"),
-            "lua": ("--lua-filter",),
-            "metadata": ("--metadata-file",),
-            "abbreviations": ("--abbreviations",),
-            "highlight": ("--highlight-style",),
-            "syntax": ("--syntax-definition",),
-            "header": ("-H", "--include-in-header"),
-            "before": ("-B", "--include-before-body"),
-            "after": ("-A", "--include-after-body"),
-            "css": ("-c", "--css"),
-            "reference": ("--reference-doc",),
-            "epubcover": ("--epub-cover-image",),
-            "epubmeta": ("--epub-metadata",),
-            "epubfont": ("--epub-embed-font",),
-            "bibliography": ("--bibliography",),
-            "csl": ("--csl",),
-            "citeabbrev": ("--citation-abbreviations",),
-        }
-    parser = argparse.ArgumentParser()
-    for dest in arguments:
-        parser.add_argument(*arguments[dest], dest=dest,
-                            action="append", default=[])
-
-    # Add the target format in case it was specified as this overrides
-    # the output format.  We also need the data directory for finding
-    # installed filters.
-    parser.add_argument("-t", "--to")
-    parser.add_argument("--data-dir", dest="datadir")
-    parser.add_argument("--template", default="default")
-
-    args, _ = parser.parse_known_args(cmd)
-    files = []
-    for dest in arguments:
-        files.extend([env.File(x) for x in getattr(args, dest)
-                      if os.path.exists(x)])
+        return None, None
 
-    # Now we need to determine the files inside the document that will
-    # influence the output.  To do this, we need to analyze the tree
-    # Pandoc will write out after all of the filters have been run.  The
-    # best parser for a Pandoc document is Pandoc itself; however, we
-    # want to interrupt the processing before the Writer is called.
-    # Looking at the filter documentation, we can achieve this by
-    # calling Pandoc with the appropriate flags and piping the JSON
-    # output through each filter.  The output format is passed as an
-    # argument to each filter so we must replicate that behavior to
-    # ensure the syntax tree has the final files.
-    #
-    # If the user provided the ``--to`` flag (with possible extensions),
-    # that _is_ the output format.  Otherwise, we take the format from
-    # the file extension.  The only exception is the 'beamer' output.
-    if args.to:
-        if args.to == "beamer":
-            format = "latex"
-        else:
-            format = re.match(r"(\w+)[-+]?", args.to).group(1)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size, datadir)
+    cached = _defaults.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1:]
 
-    else:
-        _, format = os.path.splitext(str(node))
-        format = format[1:]
+    try:
+        with open(path, encoding="utf-8") as stream:
+            data = yaml.safe_load(stream) or {}
+    except (OSError, UnicodeDecodeError, yaml.YAMLError) as err:
+        raise SCons.Errors.UserError(
+                "Cannot read the Pandoc defaults file '{0}': {1}".format(
+                    path, err
+                ))
 
-    # Now that we have the format, we can figure out if the template was
-    # defined and inside the project.  First, we need the root of the
-    # build and the template.
-    template = args.template
-    # Add the extension if needed.
-    _, ext = os.path.splitext(template)
-    if ext == "":
-        template = template + "." + format
+    if not isinstance(data, dict):
+        raise SCons.Errors.UserError(
+                "The Pandoc defaults file '{0}' is not a mapping".format(path)
+            )
 
-    # First, check that the file exists or is findable in the data
-    # directory.
-    if not os.path.exists(template):
-        if args.datadir:
-            template = os.path.join(args.datadir, "templates", template)
+    root = os.path.dirname(path) or "."
 
-    if os.path.exists(template) and format not in ("docx", "pptx"):
-        files.append(env.File(template))
+    def expand(value):
+        """Expand the variables in a path"""
+        value = str(value).replace("${.}", root)
+        value = value.replace("${USERDATA}", datadir or "")
+        return re.sub(r"\$\{(\w+)\}",
+                      lambda x: os.environ.get(x.group(1), x.group(0)),
+                      value)
 
-    def run_command(cmd, proc=None):
-        """Helper function for running a command
-        """
-        logger = logging.getLogger(__name__+".scanner.run_command")
-        logger.debug("command: '{0}'".format(" ".join(cmd)))
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stdin=proc.stdout if proc else None)
-        return proc
+    def items(value):
+        """The items of a setting that may be a list"""
+        return value if isinstance(value, list) else [value]
 
-    # We need to run each filter in order; however, we also need to
-    # run any Lua filters in their proper location.  We can do this
-    # by reading from the front of the command until we find a
-    # filter.  We consume the command until we find a filter and run
-    # each stage.  We start by processing the input files.
-    proc = None
-    cmd_ = []
-    cmd0 = [_detect(env), "--from", "json", "--to", "json"] + (
-        ["--data-dir={0}".format(args.datadir)] if args.datadir else []
-    )
-    sources = [x.path for x in node.sources if os.path.exists(x.path)]
-    while cmd and sources:
-        # Grab the first item off the list
-        item = cmd.pop(0)
-        # Is this a 'to' flag?
-        match = re.match(r"(-T|--to=?)([-+\w+]+)?", item)
-        if match:
-            if not match.group(2):
-                cmd.pop(0)
+    options = []
 
+    def add(name, value=None):
+        """Add an option"""
+        if value is None:
+            options.append(_Option(name, None, (name,)))
+        else:
+            options.append(_Option(name, value, (name + "=" + value,)))
+
+    for key, value in data.items():
+        if key not in _defaults_keys or value is None or value is False:
             continue
 
-        # Determine if it is a filter
-        match = re.match(r"(-F|--filter=?)([-\w/.]+)?", item)
-        if match:
-            # Grab the filter
-            filt = match.group(2) if match.group(2) else cmd.pop(0)
-            logger.debug("cmd : '{0}'".format(" ".join(cmd)))
-            logger.debug("item: '{0}'".format(item))
-            logger.debug("filt: '{0}'".format(filt))
-            logger.debug("cmd_: '{0}'".format(" ".join(cmd_)))
+        name = _defaults_keys[key]
 
-            # First, deal with any intervening commands
-            if cmd_:
-                if proc:
-                    proc = run_command(cmd0 + cmd_, proc)
+        if key == "filters":
+            for item in items(value):
+                kind = item.get("type") if isinstance(item, dict) else None
+                item = item.get("path") if isinstance(item, dict) else item
+                if item == "citeproc" or kind == "citeproc":
+                    add("--citeproc")
+                elif kind == "lua" or (kind is None and
+                                       str(item).endswith(".lua")):
+                    add("--lua-filter", expand(item))
                 else:
-                    # If this is the first filter, we need to process the
-                    # input files.
-                    cmd_.extend(["--to", "json"])
-                    cmd_.extend(sources)
-                    proc = run_command(cmd_)
-
-            # Now figure out the filter.
-            cmd_ = _find_filter(filt, args.datadir, env)
-            proc = run_command(cmd_ + [format], proc)
-            cmd_ = []
-        else:
-            # Otherwise, put it on the running command.
-            cmd_.append(item)
+                    add("--filter", expand(item))
 
-    # Now process any arguments after the last filter
-    if cmd_:
-        if proc:
-            proc = run_command(cmd0 + cmd_, proc)
-        else:
-            # If we have no filters, process the sources.
-            cmd_.extend(["--to", "json"])
-            cmd_.extend(sources)
-            proc = run_command(cmd_)
+        elif key in ("metadata", "variables"):
+            # Repeated values of a key make a list like the command line.
+            for field, entry in (value.items() if isinstance(value, dict)
+                                 else []):
+                for item in items(entry):
+                    if isinstance(item, bool):
+                        item = "true" if item else "false"
 
-    doc = panflute.load(proc.stdout) if proc else None
+                    if isinstance(item, (str, int, float)):
+                        add(name, "{0}={1}".format(field, item))
+
+        elif key == "cite-method":
+            if value in ("natbib", "biblatex"):
+                add("--" + value)
+
+        elif key == "request-headers":
+            # A list of name and value pairs
+            for item in items(value):
+                if isinstance(item, list) and len(item) == 2:
+                    add(name, "{0}:{1}".format(*item))
+
+        elif key == "resource-path":
+            add(name, os.pathsep.join(expand(x) for x in items(value)))
+
+        elif value is True:
+            add(name)
 
-    def _path(x):
-        """A helper for getting the path right"""
-        root = os.path.dirname(str(node))
-        if os.path.commonprefix([root, x]) == root:
-            return env.File(x)
         else:
-            return env.File(os.path.join(root, x))
+            for item in items(value):
+                if isinstance(item, (str, int, float)):
+                    add(name, expand(item))
 
-    # For images, we only concern ourselves with outputs that are a
-    # final stage.  This includes formats such as 'docx', 'pptx',
-    # 'html', and 'epub'.  It excludes 'markdown' and 'latex'.  The
-    # rationale is these are not delivery formats and, therefore, still
-    # need to be processed as another stage in SCons.  That is when the
-    # scanning needs to be done.  We also exclude PDF because SCons has
-    # a better scanner built in. (And why would you want to use SCons if
-    # you just want to use Pandoc to go straight to PDF?)
-    skip = (
-            "asciidoc",
-            "commonmark",
-            "context",
-            "gfm",
-            "json",
-            "latex",
-            "markdown",
-            "markdown_mmd",
-            "markdown_phpextra",
-            "markdown_strict",
-            "native",
-            "org",
-            "plain",
-            "rst",
-            "tex",
-        )
-    if format not in skip:
-        def walk(src):
-            """Walk the tree and find images and bibliographies
-            """
-            if isinstance(src, panflute.Image):
-                return [src.url]
-            else:
-                tmp = [walk(y) for y in getattr(src, "content", [])]
-                return [y for z in tmp for y in z if y]
+    inherited = [expand(x) for x in items(data.get("defaults") or [])]
+    _defaults[path] = (stamp, inherited, options)
+    return inherited, options
 
-        images = [x for x in walk(doc) if x]
-        logger.debug("images: {0}".format(images))
-        files.extend([_path(x) for x in images])
 
-    # And, finally, check the metadata for a bibliography file
-    if doc:
-        if not args.bibliography:
-            bibs = doc.metadata.content.get("bibliography", [])
-            if bibs:
-                files.extend([_path(x.text) for x
-                              in getattr(bibs, "content", [bibs])])
+def _with_defaults(options, datadir, env, seen=(), search=True):
+    """Replace the defaults files in the options with their settings
 
-    logger.debug("{0!s}: {1!s}".format(node, [str(x) for x in files]))
-    return files
+    Like Pandoc, the settings of a file apply where ``--defaults``
+    appears so later options override them or add to their lists.  The
+    files a defaults file inherits apply before it.  A file that cannot
+    be found or read is left on the command line for Pandoc to report.
+    ``search`` is passed on to :func:`_find_defaults`.
 
+    Returns
+    -------
 
-_builder = SCons.Builder.Builder(
-        action=SCons.Action.Action("$PANDOCCOM", "$PANDOCCOMSTR"),
-        target_scanner=SCons.Scanner.Scanner(_scanner),
-    )
+    options: tuple
+        The :class:`_Option` of each argument after the replacement
 
+    files: list
+        The defaults files that were used
 
-def generate(env):
-    """Add the Builders and construction variables to the Environment
     """
-    env["PANDOC"] = _detect(env)
-    command = "$PANDOC $PANDOCFLAGS -o ${TARGET} ${SOURCES}"
-    env.SetDefault(
-            # Command line flags.
-            PANDOCFLAGS=SCons.Util.CLVar("--standalone"),
-
-            # Commands.
-            PANDOCCOM=command,
-            PANDOCCOMSTR="",
+    result = []
+    files = []
+    for option in options:
+        path = _find_defaults(option.value, datadir, env, search) \
+            if option.name == "--defaults" and option.value else None
+        if path is None or path in seen:
+            result.append(option)
+            continue
 
-        )
-    env["BUILDERS"]["Pandoc"] = _builder
-    return
+        files.append(path)
+        inherited, settings = _load_defaults(path, datadir)
+        if settings is None:
+            result.append(option)
+            continue
 
+        parents, more = _with_defaults(
+                [_Option("--defaults", x, ("--defaults", x))
+                 for x in inherited], datadir, env, seen + (path,), search
+            )
+        result.extend(parents)
+        result.extend(settings)
+        files.extend(more)
 
-def exists(env):
-    pandoc = _detect(env)
-    proc = subprocess.run([pandoc, "--version"], capture_output=True,
-                          text=True)
-    match = re.match(r"pandoc\s+(\d+[.]\d+)", proc.stdout, re.IGNORECASE)
-    if not match:
-        raise SCons.Errors.StopError(
-            PandocVersionMissing,
-            f"Could not determine Pandoc version from: '{proc.stdout}'"
-        )
+    return tuple(result), files
 
-    pandoc_version_ = match.group(1)
-    if pandoc_version_ == "2.10":
-        raise SCons.Errors.StopError(
-            PandocBadVersion, "Pandoc 2.10 is not supported"
-        )
 
-    try:
-        pandoc_version = tuple(
-            int(_) for _ in pandoc_version_.split(".")
-            if re.match(r"^(\d)+$", _)
-        )
-    except ValueError:
-        raise SCons.Errors.StopError(
-            PandocBadVersion,
-            f"Could not parse Pandoc version {pandoc_version_}"
-        )
+def _marked(filt, marks):
+    """Look up a filter in the user's marks
 
-    try:
-        panflute_version_ = metadata.version("panflute")
-    except metadata.PackageNotFoundError:
-        raise SCons.Errors.StopError(
-                PanfluteNotFound, "Could not find panflute"
-            )
+    The ``marks`` is either a list of filters or a dictionary keyed on
+    filters.  The filter matches as given on the command line or by its
+    base name.
+
+    Returns
+    -------
+
+    mark:
+        The value in the dictionary, True for a list, or None if the
+        filter is not marked
+
+    """
+    for name in (filt, os.path.basename(filt)):
+        if name in marks:
+            return marks[name] if isinstance(marks, dict) else True
+
+    return None
+
+
+def _detect(env):
+    """Try to find Pandoc
+
+    The default ``$PANDOC`` only looks for Pandoc when it is expanded.
+
+    """
+    return env.subst("$PANDOC") or _pandoc_path(env)
+
+
+# The Pandoc found on each search path.
+_pandoc_paths = {}
+
+
+def _where(env):
+    """Find Pandoc on the path of the Environment once per process"""
+    path = str(env["ENV"].get("PATH"))
+    if path not in _pandoc_paths:
+        _pandoc_paths[path] = env.WhereIs("pandoc")
+
+    return _pandoc_paths[path]
+
+
+def _pandoc_path(env):
+    """Find Pandoc for the default ``$PANDOC``
+
+    If Pandoc is not on the path, a warning is issued once and the
+    commands are left to fail.
+
+    """
+    pandoc = _where(env)
+    if pandoc:
+        return pandoc
+
+    if None not in _checked:
+        _checked.add(None)
+        SCons.Warnings.warn(PandocNotFound, "Could not find Pandoc")
+
+    return "pandoc"
+
+
+# The Pandoc executables with a supported version.
+_checked = set()
+
+
+def _check(env):
+    """Check the version of Pandoc the first time it is used
+
+    This runs ``pandoc --version`` unless the probe is in the scan cache
+    so it is left until a document is scanned or built.
+
+    """
+    pandoc = _detect(env)
+    if pandoc in _checked:
+        return
 
     try:
-        panflute_version = tuple(
-            int(_) for _ in panflute_version_.split(".")
-            if re.match(r"^\d+$", _)
+        probe = _probe(env)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise SCons.Errors.StopError(
+            PandocVersionMissing,
+            f"Could not run '{pandoc} --version': {err}"
         )
-    except ValueError:
+
+    if not probe.version:
         raise SCons.Errors.StopError(
-            PanfluteBadVersion,
-            f"Could not parse panflute version {panflute_version_}"
+            PandocVersionMissing,
+            f"Could not determine Pandoc version from: '{probe.banner}'"
         )
 
-    if any(pandoc_version < (2, 10) and panflute_version >= (2,),
-           pandoc_version > (2, 10) and panflute_version < (2,)):
+    if probe.version < (2, 7):
+        pandoc_version_ = ".".join(str(_) for _ in probe.version)
         raise SCons.Errors.StopError(
-                PanflutePandocVersionSkew,
-                f"Incompatible Pandoc (version {pandoc_version_}) and "
-                f"Panflute (version {panflute_version_}) found"
+            PandocBadVersion,
+            f"Pandoc {pandoc_version_} is not supported; 2.7 or newer is "
+            f"required"
+        )
+
+    _checked.add(pandoc)
+
+
+class _Probe(object):
+    """The facts about a Pandoc executable needed by the Tool
+
+    The ``data`` holds the ``--version`` banner and user data directory
+    and, once requested, the supported input and output formats.  Each
+    is only queried from Pandoc if it is missing from ``data``.  The
+    ``cache`` is marked dirty when ``data`` is updated so the probe is
+    persisted with the scan cache.
+
+    """
+    def __init__(self, pandoc, data, cache):
+        self.pandoc = pandoc
+        self.data = data
+        self.cache = cache
+        if "banner" not in data:
+            output = subprocess.check_output([pandoc, "--version"],
+                                             universal_newlines=True)
+            lines = output.split("\n")
+            data["banner"] = lines[0].strip()
+            data["datadir"] = None
+            for line in lines:
+                pattern = r"\s*(?:Default )?user data directory:\s*(.*)"
+                match = re.match(pattern, line, re.IGNORECASE)
+                if match:
+                    data["datadir"] = match.group(1).strip()
+                    break
+
+            self.cache.dirty = True
+
+    @property
+    def banner(self):
+        """The first line of the ``pandoc --version`` output"""
+        return self.data["banner"]
+
+    @property
+    def version(self):
+        """The version as a tuple of integers or None if not found"""
+        match = re.match(r"pandoc\S*\s+(\d+(?:[.]\d+)*)", self.banner,
+                         re.IGNORECASE)
+        if not match:
+            return None
+
+        return tuple(int(_) for _ in match.group(1).split("."))
+
+    @property
+    def datadir(self):
+        """The default user data directory"""
+        return self.data["datadir"]
+
+    def _formats(self, kind):
+        if kind not in self.data:
+            output = subprocess.check_output(
+                    [self.pandoc, "--list-{0}-formats".format(kind)],
+                    universal_newlines=True
+                )
+            self.data[kind] = output.split()
+            self.cache.dirty = True
+
+        return self.data[kind]
+
+    @property
+    def input_formats(self):
+        """The formats Pandoc can read"""
+        return self._formats("input")
+
+    @property
+    def output_formats(self):
+        """The formats Pandoc can write"""
+        return self._formats("output")
+
+
+_probes = {}
+
+
+def _probe(env):
+    """Probe the Pandoc used by the Environment
+
+    The result is memoized for the whole process and persisted in the
+    scan cache keyed on the path, size, and modification time of the
+    executable.  Therefore, ``pandoc --version`` is run at most once
+    per executable instead of once per query.
+
+    Returns
+    -------
+
+    probe: :class:`_Probe`
+        The version, data directory and formats of Pandoc
+
+    """
+    pandoc = _detect(env)
+    path = pandoc if os.path.isfile(pandoc) else env.WhereIs(pandoc)
+    try:
+        stat = os.stat(path)
+        key = "{0}:{1}:{2}".format(os.path.realpath(path), stat.st_size,
+                                   stat.st_mtime)
+    except (OSError, TypeError):
+        key = pandoc
+
+    cache = _scan_cache(env)
+    if key not in _probes:
+        data = cache.probes.get(key, {})
+        _probes[key] = _Probe(pandoc, data, cache)
+
+    if key not in cache.probes:
+        cache.probes[key] = _probes[key].data
+        cache.dirty = True
+
+    return _probes[key]
+
+
+def _stringify(value):
+    """Convert a metadata value from the JSON syntax tree to strings
+
+    A ``MetaList`` becomes one string per item.  Any other value is
+    flattened to the text it contains the same way
+    :func:`panflute.stringify` does.  The traversal is iterative so
+    deeply nested values do not hit the recursion limit.
+
+    """
+    if isinstance(value, dict) and value.get("t") == "MetaList":
+        return [y for x in value.get("c", []) for y in _stringify(x)]
+
+    text = []
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            text.append(item)
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, dict):
+            tag = item.get("t")
+            if tag in ("Space", "SoftBreak", "LineBreak"):
+                text.append(" ")
+            elif tag in ("Code", "Math", "RawInline"):
+                text.append(item["c"][1])
+            elif tag in ("Str", "MetaString"):
+                text.append(item["c"])
+            elif tag in ("Emph", "Strong", "Strikeout", "Superscript",
+                         "Subscript", "SmallCaps", "Underline", "Para",
+                         "Plain", "MetaInlines", "MetaBlocks"):
+                stack.append(item["c"])
+            elif tag in ("Quoted", "Span", "Cite", "Link"):
+                stack.append(item["c"][1])
+
+    text = "".join(text)
+    return [text] if text else []
+
+
+def _extract(stream, images=True, size=1 << 16):
+    """Extract the dependencies from a Pandoc JSON syntax tree
+
+    The ``stream`` is read incrementally in chunks of ``size`` bytes
+    and tokenized by :func:`_extractor` without building the document
+    tree.  If ``images`` is false, the URLs are not collected.
+
+    Returns
+    -------
+
+    result: dict
+        The image URLs, the cited keys, and the metadata bibliography
+        files found in the document under the keys ``"images"``,
+        ``"citations"``, and ``"bibliography"``
+
+    """
+    if _profile.path:
+        stream = _profile.counted(stream)
+
+    # Take what the pipe has instead of waiting for a full chunk so bad
+    # output is seen before the stage exits.
+    read = getattr(stream, "read1", stream.read)
+    parser = _extractor(images, size)
+    try:
+        wanted = next(parser)
+        while True:
+            wanted = parser.send(read(wanted))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def _extract_async(stream, images=True, size=1 << 16):
+    """Extract the dependencies like :func:`_extract` from an
+    :class:`asyncio.StreamReader`
+    """
+    parser = _extractor(images, size)
+    try:
+        wanted = next(parser)
+        while True:
+            data = await stream.read(wanted)
+            _profile.add("bytes", len(data))
+            wanted = parser.send(data)
+    except StopIteration as stop:
+        return stop.value
+
+
+def _extractor(images=True, size=1 << 16):
+    """Tokenize a Pandoc JSON syntax tree for :func:`_extract`
+
+    This is a generator so the document can be fed from any source.
+    Each ``yield`` gives the number of bytes wanted and receives the
+    next bytes of the document or nothing at the end.  Only the
+    ``Image`` URLs, the ``citationId`` of each citation, and the
+    ``bibliography`` entry of the metadata are retained.  The URL is
+    the first item of the third element of the ``"c"`` field of an
+    element tagged ``"Image"``.  The result is the
+    value of the final :class:`StopIteration`.
+
+    """
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+
+    def read(count):
+        """Get the next text of the document"""
+        while True:
+            data = yield count
+            text = decode(data, not data)
+            if text or not data:
+                return text
+
+    scan = json.decoder.scanstring
+    literal = re.compile(r"[-+.\w]*")
+    # Each frame on the stack is a list of: a flag for an object, the
+    # current key or index, the element tag, the candidate image URL,
+    # and the container being built for the bibliography.
+    stack = []
+    frame = None
+    urls = []
+    citations = set()
+    bibliography = None
+    capture = None
+    buf = ""
+    pos = 0
+    while True:
+        if pos >= len(buf):
+            buf = yield from read(size)
+            pos = 0
+            if not buf:
+                break
+
+        char = buf[pos]
+        if char == '"':
+            try:
+                value, end = scan(buf, pos + 1)
+            except ValueError:
+                # The string straddles the end of the buffer.  Grow the
+                # buffer geometrically to avoid rescanning long strings
+                # over and over.
+                chunk = yield from read(max(size, len(buf)))
+                if not chunk:
+                    raise
+
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            pos = end
+            if frame is not None and frame[0] and frame[1] is None:
+                # This is a key and not a value
+                frame[1] = value
+                pos += 1
+                continue
+
+        elif char in ",: \t\r\n":
+            pos += 1
+            continue
+
+        elif char == "{" or char == "[":
+            pos += 1
+            obj = None
+            if capture is None and len(stack) == 2 \
+                    and stack[0][1] == "meta" \
+                    and stack[1][1] == "bibliography":
+                capture = len(stack)
+
+            if capture is not None:
+                obj = {} if char == "{" else []
+
+            frame = [char == "{", None if char == "{" else 0,
+                     None, None, obj]
+            stack.append(frame)
+            continue
+
+        elif char == "}" or char == "]":
+            pos += 1
+            done = stack.pop()
+            frame = stack[-1] if stack else None
+            if images and done[2] == "Image" and done[3] is not None:
+                urls.append(done[3])
+
+            value = done[4]
+            if capture is not None and len(stack) == capture:
+                bibliography = value
+                capture = None
+                value = None
+
+        else:
+            # Numbers and literals may also straddle the end of the
+            # buffer.  The JSON decoder validates the token.
+            end = literal.match(buf, pos).end()
+            if end == len(buf):
+                chunk = yield from read(size)
+                if chunk:
+                    buf = buf[pos:] + chunk
+                    pos = 0
+                    continue
+
+            value = json.loads(buf[pos:end] or char)
+            pos = end
+
+        if frame is None:
+            continue
+
+        if char == '"' and capture is None:
+            if frame[0]:
+                if frame[1] == "t":
+                    frame[2] = value
+                elif frame[1] == "citationId":
+                    citations.add(value)
+                elif frame[1] == "bibliography" and len(stack) == 2 \
+                        and stack[0][1] == "meta":
+                    bibliography = value
+
+            elif images and frame[1] == 0 and len(stack) > 2 \
+                    and stack[-2][1] == 2 and not stack[-2][0] \
+                    and stack[-3][1] == "c" and stack[-3][0]:
+                stack[-3][3] = value
+
+        # Record the completed value in its parent
+        if frame[4] is not None:
+            if frame[0]:
+                frame[4][frame[1]] = value
+            else:
+                frame[4].append(value)
+
+        if frame[0]:
+            frame[1] = None
+        else:
+            frame[1] += 1
+
+    return {
+            "images": urls,
+            "citations": sorted(citations),
+            "bibliography": (_stringify(bibliography)
+                             if bibliography is not None else []),
+        }
+
+
+def _pipeline(stages, consume, data=None, timeout=None, limit=1 << 16):
+    """Run a pipeline of commands and consume the output of the last
+
+    Each command in ``stages`` reads the standard output of the previous
+    one and the first reads the bytes ``data``, if given.  The parent
+    closes its copy of each pipe as soon as the next stage has it so a
+    failing stage ends the pipeline instead of stalling it.  The last
+    ``limit`` bytes of the standard error of each stage are kept for the
+    error message, the stages still running after ``timeout`` seconds
+    are killed, and every process is reaped before returning.
+
+    Returns
+    -------
+
+    result:
+        The value returned by ``consume`` called with the output stream
+        of the last stage
+
+    """
+    logger = logging.getLogger(__name__ + ".scanner.run_command")
+    procs = []
+    threads = []
+    expired = []
+
+    def drain(stream, buf):
+        with stream:
+            for chunk in iter(lambda: stream.read(4096), b""):
+                buf.extend(chunk)
+                del buf[:-limit]
+
+    def feed(stream):
+        try:
+            with stream:
+                stream.write(data)
+        except OSError:
+            # The stage exited early; its status tells why.
+            pass
+
+    def expire():
+        for cmd, proc, _, _ in procs:
+            if proc.poll() is None:
+                expired.append(cmd)
+                proc.kill()
+
+    def thread(target, *args):
+        threads.append(threading.Thread(target=target, args=args,
+                                        daemon=True))
+        threads[-1].start()
+
+    timer = None
+    result = None
+    error = None
+    unstarted = None
+    killed = []
+    try:
+        stdin = subprocess.DEVNULL if data is None else subprocess.PIPE
+        for cmd in stages:
+            logger.debug("command: '{0}'".format(" ".join(cmd)))
+            _profile.add("processes")
+            unstarted = cmd
+            proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            unstarted = None
+            if stdin is subprocess.PIPE:
+                thread(feed, proc.stdin)
+            elif procs:
+                procs[-1][1].stdout.close()
+
+            stdin = proc.stdout
+            procs.append((cmd, proc, time.time(), bytearray()))
+            thread(drain, proc.stderr, procs[-1][-1])
+
+        if timeout:
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+
+        stdout = procs[-1][1].stdout
+        result = consume(stdout)
+        while not stdout.closed and stdout.read(1 << 16):
+            pass
+    except Exception as err:
+        error = err
+    finally:
+        for _, proc, _, _ in procs:
+            if not proc.stdout.closed:
+                proc.stdout.close()
+
+            if error is not None and proc.poll() is None:
+                killed.append(proc)
+                proc.kill()
+
+        for cmd, proc, start, _ in procs:
+            proc.wait()
+            _profile.stage(_stage_name(cmd), time.time() - start)
+
+        if timer:
+            timer.cancel()
+
+        for item in threads:
+            item.join(1)
+
+    _check_pipeline(procs, expired, timeout, error, killed, unstarted)
+    return result
+
+
+def _check_pipeline(procs, expired, timeout, error, killed=(),
+                    unstarted=None):
+    """Report the failure of a finished pipeline
+
+    The ``procs`` are the command, process, start time, and standard
+    error of each stage, ``expired`` are the commands killed after
+    ``timeout`` seconds, and ``error`` is the exception raised while
+    starting the stages or reading the output.  The ``killed`` processes
+    were stopped because of the ``error`` and ``unstarted`` is the
+    command that could not be started, if any.
+
+    """
+    logger = logging.getLogger(__name__ + ".scanner.run_command")
+    if unstarted is not None:
+        raise SCons.Errors.UserError(
+                "Pandoc scan stage '{0}' could not be started: {1}".format(
+                    _stage_name(unstarted), error
+                ))
+
+    # A stage killed by a broken pipe only lost its reader so we report
+    # the stage that actually failed.
+    broken = -getattr(signal, "SIGPIPE", 0)
+    failed = [x for x in procs if x[1] not in killed and
+              x[1].returncode not in (0, broken)]
+    if expired:
+        raise SCons.Errors.UserError(
+                "Pandoc scan stage '{0}' timed out after {1} s".format(
+                    _stage_name(expired[0]), timeout
+                ))
+    elif failed:
+        cmd, proc, _, buf = failed[0]
+        message = buf.decode("utf-8", "replace").strip()
+        raise SCons.Errors.UserError(
+                "Pandoc scan stage '{0}' failed with exit status {1}{2}"
+                .format(_stage_name(cmd), proc.returncode,
+                        ": " + message if message else "")
             )
+    elif isinstance(error, ValueError) and procs:
+        raise SCons.Errors.UserError(
+                "Pandoc scan stage '{0}' wrote an invalid syntax tree: {1}"
+                .format(_stage_name(procs[-1][0]), error)
+            )
+    elif error is not None:
+        raise error
+
+    for cmd, _, _, buf in procs:
+        if buf:
+            logger.debug("{0}: {1}".format(
+                    _stage_name(cmd), buf.decode("utf-8", "replace")
+                ))
+
+
+_readers = collections.OrderedDict()
+_readers_lock = threading.Lock()
+
+
+def _reader_future(cmd, size=16):
+    """Get the memoized output of a reader command
+
+    The syntax trees written by the last ``size`` commands are kept so
+    targets sharing a reader, like the outputs of :func:`_PandocMulti`,
+    only parse their sources once per build.
+
+    Returns
+    -------
+
+    future: :class:`concurrent.futures.Future`
+        The future output of the command
+
+    owner: bool
+        Whether the caller must run the command and set the result
+
+    """
+    key = tuple(cmd)
+    with _readers_lock:
+        future = _readers.get(key)
+        owner = future is None
+        if owner:
+            future = _readers[key] = concurrent.futures.Future()
+            while len(_readers) > size:
+                _readers.popitem(last=False)
+        else:
+            _readers.move_to_end(key)
+
+    return future, owner
+
+
+def _reader_failed(cmd, future, err):
+    """Forget a reader that failed so the next scan runs it again"""
+    future.set_exception(err)
+    with _readers_lock:
+        if _readers.get(tuple(cmd)) is future:
+            del _readers[tuple(cmd)]
+
+
+def _reader_output(cmd, timeout=None):
+    """Run a reader command once and remember its output
+
+    Concurrent scans wait for the first one to finish the command.
+
+    """
+    future, owner = _reader_future(cmd)
+    if owner:
+        try:
+            future.set_result(_pipeline([cmd], lambda x: x.read(),
+                                        timeout=timeout))
+        except Exception as err:
+            _reader_failed(cmd, future, err)
+
+    return future.result()
+
+
+def _run_scan(stages, images=True, shared=False, timeout=None):
+    """Run the scan pipeline and extract the document dependencies
+
+    Each stage in ``stages`` is a command whose standard output is piped
+    into the standard input of the next stage by :func:`_pipeline`.  The
+    final stage must write the Pandoc JSON syntax tree.  If ``images``
+    is false, the image URLs are not collected.  If ``shared`` is true,
+    the output of the first stage is taken from :func:`_reader_output`.
+    Each stage may run for ``timeout`` seconds.
+
+    Returns
+    -------
+
+    result: dict
+        The image URLs and the metadata bibliography files found in the
+        filtered document under the keys ``"images"`` and
+        ``"bibliography"``
+
+    """
+    def extract(stream):
+        with _profile.timer("extract_seconds"):
+            return _extract(stream, images)
+
+    data = None
+    if shared:
+        data = _reader_output(stages[0], timeout)
+        stages = stages[1:]
+        if not stages:
+            return extract(io.BytesIO(data))
+
+    return _pipeline(stages, extract, data, timeout)
+
+
+class _Slots(object):
+    """Limit the processes the asyncio scan engine runs at once
+
+    A pipeline takes a slot for each stage, up to ``total``, all at once
+    so the pipelines waiting for slots do not hold any.
+
+    """
+    def __init__(self, total):
+        import asyncio
+        self.total = max(total, 1)
+        self.free = self.total
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, count):
+        count = min(count, self.total)
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.free >= count)
+            self.free -= count
+
+        return count
+
+    async def release(self, count):
+        async with self.cond:
+            self.free += count
+            self.cond.notify_all()
+
+
+async def _pipeline_async(stages, consume, data=None, timeout=None,
+                          slots=None, limit=1 << 16):
+    """Run a pipeline like :func:`_pipeline` with :mod:`asyncio`
+
+    The stages are connected with operating system pipes so the document
+    streams between them without passing through Python, and the
+    coroutine function ``consume`` reads the output of the last stage.
+    The stages wait for their ``slots``, if given, before starting.  If
+    the coroutine is cancelled, the stages are killed and reaped.
+
+    """
+    import asyncio
+
+    logger = logging.getLogger(__name__ + ".scanner.run_command")
+    procs = []
+    tasks = []
+    fds = []
+    expired = []
+
+    async def drain(stream, buf):
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                break
+
+            buf.extend(chunk)
+            del buf[:-limit]
+
+    async def feed(stream):
+        try:
+            stream.write(data)
+            await stream.drain()
+        except OSError:
+            # The stage exited early; its status tells why.
+            pass
+        finally:
+            stream.close()
+
+    def expire():
+        for cmd, proc, _, _ in procs:
+            if proc.returncode is None:
+                expired.append(cmd)
+                proc.kill()
+
+    loop = asyncio.get_event_loop()
+    held = await slots.acquire(len(stages)) if slots else 0
+    timer = None
+    result = None
+    error = None
+    unstarted = None
+    killed = []
+    try:
+        stdin = asyncio.subprocess.DEVNULL if data is None \
+            else asyncio.subprocess.PIPE
+        for idx, cmd in enumerate(stages):
+            reader, stdout = None, asyncio.subprocess.PIPE
+            if idx + 1 < len(stages):
+                reader, stdout = os.pipe()
+                fds.extend([reader, stdout])
+
+            logger.debug("command: '{0}'".format(" ".join(cmd)))
+            _profile.add("processes")
+            unstarted = cmd
+            proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=stdin, stdout=stdout,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            unstarted = None
+            procs.append((cmd, proc, time.time(), bytearray()))
+            tasks.append(loop.create_task(drain(proc.stderr, procs[-1][-1])))
+            if data is not None and idx == 0:
+                tasks.append(loop.create_task(feed(proc.stdin)))
+
+            # The parent does not need its copies of the pipe.
+            for fd in (stdin, stdout):
+                if fd in fds:
+                    fds.remove(fd)
+                    os.close(fd)
+
+            stdin = reader
+
+        if timeout:
+            timer = loop.call_later(timeout, expire)
+
+        stdout = procs[-1][1].stdout
+        result = await consume(stdout)
+        while await stdout.read(1 << 16):
+            pass
+    except BaseException as err:
+        error = err
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+        for _, proc, _, _ in procs:
+            if error is not None and proc.returncode is None:
+                killed.append(proc)
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+
+        for cmd, proc, start, _ in procs:
+            await proc.wait()
+            _profile.stage(_stage_name(cmd), time.time() - start)
+
+        if timer:
+            timer.cancel()
+
+        if tasks:
+            _, running = await asyncio.wait(tasks, timeout=1)
+            for task in running:
+                task.cancel()
+
+        if held:
+            await slots.release(held)
+
+    if isinstance(error, asyncio.CancelledError) or \
+            not isinstance(error, (Exception, type(None))):
+        raise error
+
+    _check_pipeline(procs, expired, timeout, error, killed, unstarted)
+    return result
+
+
+async def _run_scan_async(stages, images=True, shared=False, timeout=None,
+                          slots=None):
+    """Run the scan pipeline like :func:`_run_scan` with :mod:`asyncio`
+
+    At most ``slots`` processes run at once if given.
+
+    """
+    import asyncio
+
+    async def extract(stream):
+        with _profile.timer("extract_seconds"):
+            return await _extract_async(stream, images)
+
+    data = None
+    if shared:
+        future, owner = _reader_future(stages[0])
+        if owner:
+            async def read(stream):
+                return await stream.read()
+
+            try:
+                future.set_result(await _pipeline_async(
+                        stages[:1], read, timeout=timeout, slots=slots
+                    ))
+            except BaseException as err:
+                _reader_failed(stages[0], future, err)
+
+        data = await asyncio.wrap_future(future)
+        stages = stages[1:]
+        if not stages:
+            return _extract(io.BytesIO(data), images)
+
+    return await _pipeline_async(stages, extract, data, timeout, slots)
+
+
+def _stage_name(cmd):
+    """Name a stage of the scan pipeline for the profile"""
+    return "pandoc" if "--to" in cmd else os.path.basename(cmd[-2])
+
+
+class _ScanCache(object):
+    """A persistent cache of scan results with LRU eviction
+
+    The entries map a content signature of everything that can change
+    the filtered syntax tree to the dependencies :func:`_run_scan`
+    extracted from it.  The results of :func:`_probe` are kept in
+    ``probes`` alongside the entries.  The cache is loaded from ``path``
+    on creation and written back when the build exits.  At most ``size``
+    entries are kept with the least recently used entry discarded first.
+    If ``path`` is empty, the cache only lives for the current process.
+    The entries missing from the cache are looked up in the shared
+    ``store`` if there is one and new entries are published to it.
+
+    """
+    format = 2
+
+    def __init__(self, path, size, store=None):
+        self.path = path
+        self.size = size
+        self.store = store
+        self.entries = collections.OrderedDict()
+        self.probes = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as stream:
+                    data = json.load(stream)
+            except (OSError, ValueError):
+                data = {}
+
+            if data.get("format") == self.format:
+                self.entries.update(data.get("entries", []))
+                self.probes.update(data.get("probes", {}))
+
+    def get(self, key):
+        """Return the entry for ``key`` or None if it is not cached"""
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            value = self.store.get(key) if self.store else None
+            if value is not None:
+                _profile.add("stored")
+                self._add(key, value)
+
+            return value
+
+        return self.entries[key]
+
+    def put(self, key, value):
+        """Store ``value`` under ``key`` and evict the stale entries"""
+        if self.store:
+            self.store.put(key, value)
+
+        self._add(key, value)
+
+    def _add(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > max(self.size, 0):
+            self.entries.popitem(last=False)
+
+        self.dirty = True
+
+    def save(self):
+        """Atomically write the cache back to disk if it changed"""
+        if not (self.path and self.dirty):
+            return
+
+        root = os.path.dirname(self.path) or os.curdir
+        fd, tmp = tempfile.mkstemp(dir=root, prefix=".pandocscan")
+        try:
+            with os.fdopen(fd, "w") as stream:
+                json.dump({"format": self.format,
+                           "probes": self.probes,
+                           "entries": list(self.entries.items())},
+                          stream)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+            return
+
+        self.dirty = False
+
+
+class _ScanStore(object):
+    """A directory of scan results shared by builds like ``CacheDir``
+
+    Each entry is a file named by its scan cache key in a subdirectory
+    named by the first two characters of the key.  An entry is written
+    to a temporary file and renamed into place so concurrent builds
+    never read a partial entry.  Reading an entry updates its
+    modification time and, if the store holds more than ``size`` bytes,
+    the least recently used entries are pruned when the build exits.  A
+    ``readonly`` store is never written.
+
+    """
+    def __init__(self, path, size, readonly):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.pruned = 0
+
+    def entry(self, key):
+        """The file holding the entry for ``key``"""
+        return os.path.join(self.path, key[:2], key + ".json")
+
+    def get(self, key):
+        """Return the entry for ``key`` or None if it is not stored"""
+        path = self.entry(key)
+        try:
+            with open(path, "r") as stream:
+                data = json.load(stream)
+        except (OSError, ValueError):
+            data = {}
+
+        if data.get("format") != _ScanCache.format:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return data.get("result")
+
+    def put(self, key, value):
+        """Publish ``value`` under ``key``"""
+        if self.readonly:
+            return
+
+        root = os.path.dirname(self.entry(key))
+        try:
+            os.makedirs(root, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=root, prefix=".pandocscan")
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, "w") as stream:
+                json.dump({"format": _ScanCache.format, "result": value},
+                          stream)
+            os.replace(tmp, self.entry(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+            return
+
+        self.writes += 1
+
+    def prune(self):
+        """Remove the least recently used entries above the size
+
+        The store is pruned to 90% of its size so the following builds
+        do not prune it again right away.
+
+        """
+        if self.readonly or self.size <= 0 or not self.writes:
+            return
+
+        entries = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(x[1] for x in entries)
+        if total <= self.size:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.size * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            self.pruned += 1
+
+    def report(self):
+        """A line with the statistics of the store"""
+        requests = self.hits + self.misses
+        return "PandocScanStore '{0}': {1} requests, {2} hits, {3} " \
+            "misses, {4:.1f}% hit rate, {5} writes, {6} pruned\n".format(
+                self.path, requests, self.hits, self.misses,
+                100.0 * self.hits / requests if requests else 0.0,
+                self.writes, self.pruned
+            )
+
+
+_scan_caches = {}
+_scan_stores = {}
+
+
+def _state_path(env, path):
+    """The absolute path of a file of the tool relative to ``env``
+
+    This avoids creating a Node for the file itself.
+
+    """
+    root, name = os.path.split(path)
+    if not root and name.startswith("#"):
+        root, name = "#", name[1:]
+
+    return os.path.join(env.Dir(root or ".").get_abspath(), name)
+
+
+def _scan_store(env):
+    """Get the shared scan store for the Environment
+
+    The directory is given by ``$PANDOCSCANSTORE`` and the maximum size
+    in bytes by ``$PANDOCSCANSTORESIZE``.  Like ``CacheDir``, the store
+    is not used with ``--cache-disable`` and not written with
+    ``--cache-readonly``.
+
+    Returns
+    -------
+
+    store: :class:`_ScanStore` or None
+        The store or None if there is none
+
+    """
+    path = env.subst("$PANDOCSCANSTORE")
+    if not path or SCons.Script.GetOption("cache_disable"):
+        return None
+
+    path = _state_path(env, path)
+    if path not in _scan_stores:
+        _scan_stores[path] = _ScanStore(
+                path, int(env.subst("$PANDOCSCANSTORESIZE") or 0),
+                bool(SCons.Script.GetOption("cache_readonly"))
+            )
+
+    return _scan_stores[path]
+
+
+def _scan_cache(env):
+    """Get the scan cache for the Environment
+
+    The location is given by ``$PANDOCSCANCACHE`` and the maximum number
+    of entries by ``$PANDOCSCANCACHESIZE``.  Environments sharing the
+    same location share the cache and the store of :func:`_scan_store`.
+
+    """
+    path = env.subst("$PANDOCSCANCACHE")
+    if path:
+        path = _state_path(env, path)
+
+    if path not in _scan_caches:
+        size = int(env.subst("$PANDOCSCANCACHESIZE") or 0)
+        _scan_caches[path] = _ScanCache(path, size, _scan_store(env))
+
+    return _scan_caches[path]
+
+
+@atexit.register
+def _save_scan_caches():
+    for cache in _scan_caches.values():
+        cache.save()
+
+    # The statistics are reported with those of CacheDir.
+    debug = SCons.Script.GetOption("cache_debug")
+    for store in _scan_stores.values():
+        store.prune()
+        logging.getLogger(__name__ + ".store").debug(store.report().strip())
+        if not debug or not store.hits + store.misses:
+            continue
+
+        if debug == "-":
+            sys.stdout.write(store.report())
+        else:
+            with open(debug, "a") as stream:
+                stream.write(store.report())
+
+
+def _scan_key(env, stages, sources, scripts, format, files=(), fast="off"):
+    """Compute the scan cache key for a document
+
+    The key is a hash of the Pandoc version, the expanded
+    ``$PANDOCCOM``, the commands in the scan pipeline, the target
+    format, the mode of the Markdown ``fast`` path, and the content
+    signatures of the sources, of the filter scripts, as found by
+    :func:`_find_filter`, and defaults files, and of the other ``files``
+    that can change the syntax tree like metadata files and the modules
+    required by Lua filters.  The mode keeps a result of the fast path
+    from being reused by a scan that runs or verifies with Pandoc.  The
+    locations of Pandoc, of the project, and of the user data directory
+    are left out so the key is the same on every machine sharing the
+    store of :func:`_scan_store`.
+
+    """
+    def csig(path):
+        """Get the content signature of a file if it exists"""
+        if os.path.isfile(path):
+            return env.File(path).get_csig()
+
+        found = env.WhereIs(path)
+        return env.File(found).get_csig() if found else None
+
+    pandoc = _detect(env)
+    top = env.Dir("#").get_abspath() + os.sep
+    datadir = _probe(env).datadir
+
+    def portable(arg):
+        """Remove the locations from an argument"""
+        if arg == pandoc:
+            return "pandoc"
+
+        if datadir:
+            arg = arg.replace(os.path.join(datadir, ""), "$DATADIR" + os.sep)
+
+        return arg.replace(top, "")
+
+    command = env.subst_target_source("$PANDOCCOM")
+    if command.startswith(pandoc + " "):
+        command = "pandoc" + command[len(pandoc):]
+
+    data = {
+            "pandoc": _probe(env).banner,
+            "command": portable(command),
+            "stages": [[portable(x) for x in stage] for stage in stages],
+            "format": format,
+            "fast": fast,
+            "sources": [(x.path, x.get_csig()) for x in sources],
+            "scripts": [(portable(x), csig(x)) for x in scripts],
+            "files": [(portable(x), csig(x)) for x in files],
+        }
+    text = json.dumps(data, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# The options understood by the Pandoc server by the long names given by
+# :func:`_tokenize`.  Each maps to the key in the request and the kind
+# of argument: 'flag' for options without an argument, 'str' and 'int'
+# for plain values, 'text' for the contents of the named file, 'file'
+# and 'files' for one or more file names whose base64 encoded contents
+# are sent with the request, and 'dict' for 'key=value' pairs.
+_server_options = {
+        "--from": ("from", "str"),
+        "--to": ("to", "str"),
+        "--standalone": ("standalone", "flag"),
+        "--template": ("template", "text"),
+        "--variable": ("variables", "dict"),
+        "--metadata": ("metadata", "dict"),
+        "--toc": ("table-of-contents", "flag"),
+        "--toc-depth": ("toc-depth", "int"),
+        "--number-sections": ("number-sections", "flag"),
+        "--shift-heading-level-by": ("shift-heading-level-by", "int"),
+        "--top-level-division": ("top-level-division", "str"),
+        "--wrap": ("wrap", "str"),
+        "--columns": ("columns", "int"),
+        "--tab-stop": ("tab-stop", "int"),
+        "--strip-comments": ("strip-comments", "flag"),
+        "--section-divs": ("section-divs", "flag"),
+        "--html-q-tags": ("html-q-tags", "flag"),
+        "--ascii": ("ascii", "flag"),
+        "--reference-links": ("reference-links", "flag"),
+        "--reference-location": ("reference-location", "str"),
+        "--id-prefix": ("identifier-prefix", "str"),
+        "--title-prefix": ("title-prefix", "str"),
+        "--citeproc": ("citeproc", "flag"),
+        "--bibliography": ("bibliography", "files"),
+        "--csl": ("csl", "file"),
+    }
+
+# Pandoc's formats for the file extensions the server can handle as
+# text.
+_server_formats = {
+        ".htm": "html",
+        ".html": "html",
+        ".json": "json",
+        ".latex": "latex",
+        ".ltx": "latex",
+        ".markdown": "markdown",
+        ".md": "markdown",
+        ".native": "native",
+        ".org": "org",
+        ".rst": "rst",
+        ".tex": "latex",
+    }
+
+
+def _server_request(cmd):
+    """Translate a Pandoc command line into a Pandoc server request
+
+    The ``cmd`` is the list of arguments without the executable.  The
+    inputs are read and sent as the text of the request along with the
+    files named by the options.  Only text inputs and outputs are
+    supported.
+
+    Returns
+    -------
+
+    request: dict or None
+        The body of the request or None if the command uses something
+        the server does not support
+
+    output: str or None
+        The output file of the command
+
+    """
+    request = {}
+    files = {}
+    inputs = []
+    output = None
+
+    def read(path):
+        """Read a text file"""
+        with open(path, "r", encoding="utf-8") as stream:
+            return stream.read()
+
+    def encode(path):
+        """Read a file for the 'files' of the request"""
+        with open(path, "rb") as stream:
+            return base64.b64encode(stream.read()).decode("ascii")
+
+    try:
+        for option in _tokenize(cmd):
+            value = option.value
+            if option.name is None:
+                if value == "-":
+                    return None, None
+
+                inputs.append(value)
+                continue
+
+            if option.name == "--output" and value is not None:
+                output = value
+                continue
+
+            if option.name not in _server_options:
+                return None, None
+
+            key, kind = _server_options[option.name]
+            if kind == "flag":
+                request[key] = value != "false"
+                continue
+
+            if value is None:
+                raise ValueError("Missing value for " + option.name)
+
+            if kind == "int":
+                request[key] = int(value)
+            elif kind == "str":
+                request[key] = value
+            elif kind == "text":
+                request[key] = read(value)
+            elif kind == "dict":
+                name, eq, value = value.partition("=")
+                request.setdefault(key, {})[name] = value if eq else True
+            else:
+                files[value] = encode(value)
+                if kind == "files":
+                    request.setdefault(key, []).append(value)
+                else:
+                    request[key] = value
+
+        if "from" not in request:
+            request["from"] = "markdown"
+            for path in inputs:
+                _, ext = os.path.splitext(path)
+                if ext.lower() in _server_formats:
+                    request["from"] = _server_formats[ext.lower()]
+                    break
+
+        if "to" not in request and output:
+            _, ext = os.path.splitext(output)
+            if ext.lower() not in _server_formats:
+                return None, None
+
+            request["to"] = _server_formats[ext.lower()]
+
+        # Pandoc writes these formats as zip or binary files.
+        binary = r"(docx|pptx|odt|epub\d?|pdf|chunkedhtml)\b"
+        if re.match(binary, request.get("to", "")):
+            return None, None
+
+        text = []
+        for path in inputs:
+            content = read(path)
+            text.append(content if content.endswith("\n")
+                        else content + "\n")
+    except (IndexError, OSError, UnicodeDecodeError, ValueError):
+        return None, None
+
+    request["text"] = "\n".join(text)
+    if files:
+        request["files"] = files
+
+    return request, output
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def _start_server(pandoc, timeout=10):
+    """Start a Pandoc server on a free local port
+
+    The server is stopped when the build exits.
+
+    Returns
+    -------
+
+    url: str or None
+        The URL of the server or None if it did not start within
+        ``timeout`` seconds
+
+    """
+    import urllib.request
+
+    logger = logging.getLogger(__name__ + ".server")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    url = "http://127.0.0.1:{0}".format(port)
+    cmd = [pandoc, "server", "--port", str(port)]
+    logger.debug("command: '{0}'".format(" ".join(cmd)))
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+
+    atexit.register(proc.terminate)
+    start = time.time()
+    while proc.poll() is None and time.time() - start < timeout:
+        try:
+            with urllib.request.urlopen(url + "/version", timeout=1):
+                return url
+        except OSError:
+            time.sleep(0.1)
+
+    proc.terminate()
+    return None
+
+
+def _server(env):
+    """Get the URL of the Pandoc server for the Environment
+
+    If ``$PANDOCBACKEND`` is 'server', this is ``$PANDOCSERVER`` or a
+    server started for the build.
+
+    Returns
+    -------
+
+    url: str or None
+        The URL of the server or None if the command line is used
+
+    """
+    if env.subst("$PANDOCBACKEND") != "server":
+        return None
+
+    url = env.subst("$PANDOCSERVER")
+    if url:
+        return url.rstrip("/")
+
+    # The actions are generated by every job of a parallel build.
+    pandoc = _detect(env)
+    with _servers_lock:
+        if pandoc not in _servers:
+            _servers[pandoc] = _start_server(pandoc)
+            if not _servers[pandoc]:
+                SCons.Warnings.warn(
+                        PandocServerWarning,
+                        "Could not start the Pandoc server; using the "
+                        "command line instead"
+                    )
+
+        return _servers[pandoc]
+
+
+def _server_convert(url, request, timeout=None):
+    """Send a conversion request to the Pandoc server
+
+    A request taking longer than ``timeout`` seconds fails with an
+    :class:`OSError`.
+
+    Returns
+    -------
+
+    output: str or bytes
+        The converted document.  Binary outputs are returned as bytes.
+
+    messages: list
+        The messages reported by Pandoc
+
+    """
+    import urllib.request
+
+    data = json.dumps(request).encode("utf-8")
+    req = urllib.request.Request(
+            url + "/", data=data,
+            headers={"Content-Type": "application/json",
+                     "Accept": "application/json"}
+        )
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        result = json.loads(response.read().decode("utf-8"))
+
+    if not isinstance(result, dict):
+        raise ValueError("Unexpected response from the Pandoc server")
+
+    output = result.get("output", "")
+    if result.get("base64"):
+        output = base64.b64decode(output)
+
+    return output, result.get("messages", [])
+
+
+class _Unsafe(Exception):
+    """The Markdown fast path cannot reproduce the Pandoc scan"""
+
+
+# The extensions Pandoc reads as Markdown when there is no ``--from``.
+_markdown = (".markdown", ".md", ".mdown", ".mdwn", ".mkd", ".mkdn",
+             ".text", ".txt")
+
+# The reader options that change the syntax tree in ways the fast path
+# does not model.
+_fast_unsafe = ("--from", "--lua-filter", "--defaults", "--file-scope",
+                "--default-image-extension", "--tab-stop")
+
+
+def _fast_plan(reader, paths, metadata):
+    """Check if the Markdown fast path can scan a reader command
+
+    Returns
+    -------
+
+    safe: bool
+        True if the sources are Markdown by extension and no option of
+        the ``reader`` changes the images or the bibliography Pandoc
+        would find
+
+    """
+    if not paths or not all(os.path.splitext(x)[1].lower() in _markdown
+                            for x in paths):
+        return False
+
+    if not all(os.path.isfile(x) for x in metadata):
+        return False
+
+    for option in _tokenize(reader):
+        if option.name in _fast_unsafe:
+            return False
+
+        if option.name == "--metadata" and \
+                re.split(r"[=:]", option.value or "")[0] == "bibliography":
+            return False
+
+    return True
+
+
+def _fast_text(value):
+    """Check a metadata string reads back from Markdown unchanged
+
+    Pandoc reads metadata strings as Markdown so anything with markup,
+    smart punctuation, or odd spacing is left to Pandoc.
+
+    """
+    if not re.fullmatch(r"[\w/.,:+=-]+( [\w/.,:+=-]+)*", value) \
+            or re.match(r"[-+]|\d+[.)]", value) \
+            or "--" in value or "..." in value \
+            or re.search(r"(?<![^\W_])_|_(?![^\W_])", value):
+        raise _Unsafe(value)
+
+    return value
+
+
+def _fast_scalar(value):
+    """Read a plain or quoted YAML scalar for :func:`_fast_metadata`"""
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] == "'":
+        value = value[1:-1].replace("''", "'")
+    elif len(value) > 1 and value[0] == value[-1] == '"' \
+            and "\\" not in value:
+        value = value[1:-1]
+    elif not value or value[0] in "'\"|>&*!{[%@`#?" or " #" in value:
+        raise _Unsafe(value)
+
+    return _fast_text(value)
+
+
+def _fast_metadata(lines, key="bibliography"):
+    """Find the files under a key in the lines of a YAML metadata block
+
+    Only a top level ``key`` holding a scalar, a flow sequence on one
+    line, or a block sequence of scalars is understood.
+
+    Returns
+    -------
+
+    bibliography: list or None
+        The values of ``key`` or None if the block does not have one
+
+    """
+    result = None
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        match = re.match(re.escape(key) + r"\s*:(.*)$", line)
+        if not match and re.match(r"""[{?]|["']""" + re.escape(key), line):
+            raise _Unsafe(line)
+
+        if not match:
+            line = next(lines, None)
+            continue
+
+        if result is not None:
+            raise _Unsafe(line)
+
+        value = match.group(1).strip()
+        result = []
+        line = next(lines, None)
+        if value.startswith("["):
+            if not value.endswith("]") or re.search(r"[\[\]'\"]",
+                                                    value[1:-1]):
+                raise _Unsafe(value)
+
+            result = [_fast_scalar(x) for x in value[1:-1].split(",")
+                      if x.strip()]
+        elif value:
+            result = [_fast_scalar(value)]
+
+        while line is not None and (not line.strip() or line[0] in " \t"
+                                    or line.startswith("-")):
+            item = re.match(r"\s*-\s+(.*)$", line)
+            if value and line.strip() or line.strip() and not item:
+                raise _Unsafe(line)
+
+            if item:
+                result.append(_fast_scalar(item.group(1)))
+
+            line = next(lines, None)
+
+    return result
+
+
+def _fast_blocks(text):
+    """Split a Markdown file into its YAML blocks and prose
+
+    Fenced and indented code and the metadata blocks are blanked.  An
+    indented line after a list item or a note is left alone because it
+    may continue the item.
+
+    Returns
+    -------
+
+    blocks: list
+        The lines of each YAML metadata block
+
+    prose: str
+        The text outside of the metadata blocks and code
+
+    """
+    lines = text.expandtabs(4).splitlines()
+    blocks = []
+    prose = []
+    nested = False
+    code = False
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+        if line.startswith("    ") and not nested and (
+                code or idx == 0 or not lines[idx - 1].strip()):
+            code = True
+            prose.append("")
+            idx += 1
+            continue
+
+        if line.strip():
+            code = False
+            if not line.startswith("    "):
+                nested = bool(re.match(
+                        r" {0,3}([-+*:~]|\d+[.)]|#\.|\(?\w\)|\[\^[^]]+\]:)"
+                        r"(\s|$)", line
+                    ))
+
+        fence = re.match(r" {0,3}(`{3,}|~{3,})", line)
+        if fence:
+            # Pandoc runs an unclosed fence to the end of the document.
+            close = re.compile(r" {0,3}" + fence.group(1)[0] + "{"
+                               + str(len(fence.group(1))) + r",}\s*$")
+            end = next((x for x in range(idx + 1, len(lines))
+                        if close.match(lines[x])), len(lines))
+            prose.extend([""] * (end + 1 - idx))
+            idx = end + 1
+            continue
+
+        if line.rstrip() == "---" \
+                and (idx == 0 or not lines[idx - 1].strip()) \
+                and idx + 1 < len(lines) and lines[idx + 1].strip():
+            end = next((x for x in range(idx + 1, len(lines))
+                        if lines[x].rstrip() in ("---", "...")), None)
+            if end is not None:
+                blocks.append(lines[idx + 1:end])
+                prose.extend([""] * (end + 1 - idx))
+                idx = end + 1
+                continue
+
+        prose.append(line)
+        idx += 1
+
+    return blocks, "\n".join(prose)
+
+
+def _fast_label(label):
+    """Normalize a reference label like Pandoc"""
+    return " ".join(label.split()).casefold()
+
+
+def _fast_images(prose, references):
+    """Find the images in Markdown prose
+
+    The link reference definitions are added to ``references``.
+
+    Returns
+    -------
+
+    images: list
+        The URL of each inline image and the label of each reference
+        image as a one item tuple
+
+    """
+    # Raw TeX environments and HTML comments are not Markdown.  The
+    # HTML elements with verbatim content are left to Pandoc.
+    prose = re.sub(r"<!--.*?-->|\\begin\{([^}]+)\}.*?\\end\{\1\}",
+                   lambda x: "\n" * x.group(0).count("\n"), prose,
+                   flags=re.S)
+    if re.search(r"<(pre|script|style|textarea)\b", prose, re.I):
+        raise _Unsafe("verbatim HTML")
+
+    for line in prose.splitlines():
+        match = re.match(r" {0,3}\[([^\]]+)\]:[ \t]*(\S*)", line)
+        if match and not match.group(1).startswith("^"):
+            label = _fast_label(match.group(1))
+            url = match.group(2)
+            if url.startswith("<") and url.endswith(">"):
+                url = url[1:-1]
+
+            if not url or label in references:
+                raise _Unsafe(line)
+
+            references[label] = _fast_url(url)
+        elif line.startswith("    ") and ("![" in line or "]:" in line):
+            # Indented code or the continuation of a list item
+            raise _Unsafe(line)
+
+    images = []
+    for para in re.split(r"\n[ \t]*\n", prose):
+        para = re.sub(r"(?<!`)(`+)(?!`).+?(?<!`)\1(?!`)", "", para,
+                      flags=re.S)
+        # Pandoc's Markdown reads TeX math between dollars, where an
+        # opening '$' is followed by a non-space and the next '$'
+        # closes it if it follows a non-space and is not followed by a
+        # digit.  Escaped dollars are neither.
+        para = re.sub(r"(?<!\\)((?:\\\\)*)\\\$", r"\1  ", para)
+        para = re.sub(r"\$\$.+?\$\$|\$(?![\s$])[^$]*(?<!\s)\$(?!\d)", " ",
+                      para, flags=re.S)
+        for match in re.finditer(r"(\\*)!\[", para):
+            if len(match.group(1)) % 2:
+                continue
+
+            end = _fast_bracket(para, match.end())
+            if end is None:
+                continue
+
+            alt = para[match.end():end - 1]
+            if para.startswith("(", end):
+                images.append(_fast_inline(para, end + 1))
+            elif para.startswith("[", end):
+                close = para.find("]", end)
+                if close < 0:
+                    raise _Unsafe(para[match.start():])
+
+                images.append((para[end + 1:close] or alt,))
+            else:
+                images.append((alt,))
+
+    return images
+
+
+def _fast_bracket(text, pos):
+    """Find the end of the bracketed text starting at ``pos``"""
+    depth = 1
+    while pos < len(text):
+        char = text[pos]
+        pos += 1
+        if char == "\\":
+            pos += 1
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+            if not depth:
+                return pos
+
+    return None
+
+
+def _fast_inline(text, pos):
+    """Read the URL of an inline image starting at ``pos``"""
+    match = re.compile(r"\s*(<[^<>\n]*>|[^\s()]*(?:\([^\s()]*\)[^\s()]*)*)"
+                       r"""(?:\s+("[^"]*"|'[^']*'|\([^)]*\)))?\s*\)""") \
+        .match(text, pos)
+    if not match:
+        raise _Unsafe(text[pos:])
+
+    url = match.group(1)
+    if url.startswith("<"):
+        url = url[1:-1]
+
+    return _fast_url(url)
+
+
+def _fast_url(url):
+    """Check Pandoc keeps a URL as written"""
+    if re.search(r"[\s<>|\"{}\[\]^`\\&]", url):
+        raise _Unsafe(url)
+
+    return url
+
+
+def _fast_scan(plan):
+    """Scan plain Markdown sources without running Pandoc
+
+    The image syntax (inline and reference images), the YAML metadata
+    blocks, and the ``--metadata-file`` files are tokenized directly.
+    Raw HTML ``<img>`` elements are not images in the syntax tree so
+    they are not dependencies in either scan.  Anything the tokenizer
+    does not model exactly makes it give up.
+
+    Returns
+    -------
+
+    result: dict or None
+        The result of the scan like :func:`_extract` without the
+        citations or None if the plan does not allow the fast path or
+        the sources need Pandoc
+
+    """
+    if not plan.fast:
+        return None
+
+    logger = logging.getLogger(__name__ + ".scanner")
+    _, paths, metadata = plan.fast
+    bibliography = None
+    try:
+        # The metadata files come first and later ones take precedence
+        for path in metadata:
+            with open(path, encoding="utf-8") as stream:
+                lines = stream.read().splitlines()
+
+            if lines and lines[0].rstrip() == "---":
+                lines = lines[1:]
+
+            if lines and lines[-1].rstrip() in ("---", "..."):
+                lines = lines[:-1]
+
+            value = _fast_metadata(lines)
+            if value is not None:
+                bibliography = value
+
+        # and the blocks in the document override them.
+        references = {}
+        images = []
+        for path in paths:
+            with open(path, encoding="utf-8") as stream:
+                blocks, prose = _fast_blocks(stream.read())
+
+            for block in blocks:
+                value = _fast_metadata(block)
+                if value is not None:
+                    bibliography = value
+
+            images.extend(_fast_images(prose, references))
+
+        urls = []
+        for image in images:
+            if isinstance(image, tuple):
+                image = references[_fast_label(image[0])]
+
+            urls.append(image)
+
+    except (_Unsafe, KeyError, OSError, UnicodeDecodeError) as err:
+        logger.debug("fast scan declined: {0!r}".format(err))
+        return None
+
+    _profile.add("fast")
+    return {"images": urls if plan.images else [],
+            "citations": None,
+            "bibliography": bibliography or []}
+
+
+def _fast_verify(plan, fast, result):
+    """Warn if the fast path and Pandoc disagree on a scan
+
+    The bibliography is not compared if it was given on the command
+    line because the scanner does not use it.
+
+    Returns
+    -------
+
+    result: dict
+        The result from Pandoc
+
+    """
+    if fast is not None:
+        for key in ("images", "bibliography"):
+            if key == "bibliography" and plan.bibliography:
+                continue
+
+            if set(fast[key]) != set(result[key]):
+                SCons.Warnings.warn(
+                        PandocFastScanMismatch,
+                        "Markdown fast scan of {0} found {1} {2} but Pandoc "
+                        "found {3}".format(
+                            ", ".join(plan.fast[1]), key,
+                            sorted(set(fast[key])), sorted(set(result[key]))
+                        )
+                    )
+
+    return result
+
+
+def _references_css(text, path):
+    """The files a style sheet imports or refers to with ``url()``"""
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    names = re.findall(r"""@import\s+["']([^"']+)["']""", text)
+    names.extend(x[1] for x in re.findall(
+            r"""url\(\s*(["']?)([^"')]+?)\1\s*\)""", text
+        ))
+    root = os.path.dirname(path)
+    return [os.path.join(root, x) for x in names]
+
+
+def _references_html(text, path):
+    """The local files an HTML fragment links to"""
+    names = re.findall(r"""<(?:link|script|img|source)\b[^>]*?"""
+                       r"""\b(?:href|src)\s*=\s*["']?([^"'\s>]+)""",
+                       text, re.I)
+    root = os.path.dirname(path)
+    return [os.path.join(root, x) for x in names] + \
+        _references_css(text, path)
+
+
+def _references_latex(text, path):
+    """The files a LaTeX fragment inputs, uses, or includes
+
+    The names are relative to the directory LaTeX runs in so each name
+    is also tried with the usual extensions.
+
+    """
+    text = re.sub(r"(?<!\\)%.*", "", text)
+    names = []
+    for name in re.findall(r"\\(?:input|include|subfile)\{([^}]+)\}",
+                           text) + re.findall(r"\\input\s+([^\s{}\\]+)",
+                                              text):
+        names.extend([name, name + ".tex"])
+
+    for name in re.findall(r"\\includegraphics\s*(?:\[[^]]*\])?\{([^}]+)\}",
+                           text):
+        names.extend([name] + [name + x for x in (".pdf", ".png", ".jpg",
+                                                  ".eps")])
+
+    for cmd, ext in (("usepackage", ".sty"), ("RequirePackage", ".sty"),
+                     ("bibliography", ".bib")):
+        for group in re.findall(r"\\" + cmd + r"\s*(?:\[[^]]*\])?\{([^}]+)\}",
+                                text):
+            names.extend(x.strip() + ext for x in group.split(","))
+
+    names.extend(re.findall(r"\\addbibresource\s*(?:\[[^]]*\])?\{([^}]+)\}",
+                            text))
+    return names
+
+
+def _references_lua(text, path):
+    """The modules and scripts a Lua filter loads
+
+    A module is searched for in the working directory and in the
+    directory of the filter, which filters commonly add to
+    ``package.path`` through ``PANDOC_SCRIPT_FILE``.
+
+    """
+    names = []
+    for module in re.findall(r"""\brequire\s*\(?\s*["']([\w.-]+)["']""",
+                             text):
+        module = module.replace(".", os.sep)
+        for root in ("", os.path.dirname(path)):
+            names.extend([os.path.join(root, module + ".lua"),
+                          os.path.join(root, module, "init.lua")])
+
+    names.extend(re.findall(
+            r"""\b(?:dofile|loadfile)\s*\(?\s*["']([^"']+)["']""", text
+        ))
+    return names
+
+
+def _references_yaml(text, path):
+    """The bibliography and style a metadata file names"""
+    lines = text.splitlines()
+    names = []
+    for key in ("bibliography", "csl"):
+        try:
+            names.extend(_fast_metadata(lines, key) or [])
+        except _Unsafe:
+            pass
+
+    return names
+
+
+_reference_parsers = {
+        ".css": _references_css,
+        ".htm": _references_html,
+        ".html": _references_html,
+        ".latex": _references_latex,
+        ".lua": _references_lua,
+        ".sty": _references_latex,
+        ".tex": _references_latex,
+        ".yaml": _references_yaml,
+        ".yml": _references_yaml,
+    }
+
+# The files each include file refers to keyed on the path along with
+# the modification time and size when it was read.
+_references = {}
+
+
+def _references_of(path):
+    """The existing files that ``path`` refers to directly
+
+    Each file is read once per build unless it changes.
+
+    """
+    parse = _reference_parsers.get(os.path.splitext(path)[1].lower())
+    if parse is None:
+        return []
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return []
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _references.get(path)
+    if cached is None or cached[0] != stamp:
+        logger = logging.getLogger(__name__ + ".scanner")
+        try:
+            with open(path, encoding="utf-8", errors="replace") as stream:
+                names = parse(stream.read(), path)
+        except OSError as err:
+            logger.debug("cannot read '{0}': {1}".format(path, err))
+            names = []
+
+        found = []
+        for name in names:
+            name = os.path.normpath(re.split(r"[?#]", name)[0])
+            if re.match(r"\w+:|//", name) or name in found \
+                    or not os.path.isfile(name):
+                continue
+
+            found.append(name)
+
+        cached = _references[path] = (stamp, found)
+
+    return cached[1]
+
+
+def _included(paths):
+    """Find the files included by ``paths`` recursively
+
+    Style sheets, HTML and LaTeX includes, Lua filters, and metadata
+    files are followed through any number of levels.  Files already
+    seen are not followed again so include cycles terminate.
+
+    Returns
+    -------
+
+    files: list
+        The paths of the included files not in ``paths``
+
+    """
+    seen = set(os.path.normpath(x) for x in paths)
+    stack = list(reversed(list(seen)))
+    result = []
+    while stack:
+        for name in _references_of(stack.pop()):
+            if name not in seen:
+                seen.add(name)
+                result.append(name)
+                stack.append(name)
+
+    return result
+
+
+def _format(to, node):
+    """Determine the output format of ``node`` given the ``--to`` flag
+    """
+    if to:
+        if to == "beamer":
+            return "latex"
+
+        return re.match(r"(\w+)[-+]?", to).group(1)
+
+    _, format = os.path.splitext(str(node))
+    return format[1:]
+
+
+def _check_formats(options, env):
+    """Check Pandoc can read and write the formats of a command
+
+    The last ``--from`` and ``--to`` formats, without their extensions,
+    must be in the lists of :func:`_probe` unless they are custom Lua
+    readers or writers.  The scan pipeline also needs the JSON reader
+    and writer.  Otherwise, the scan would fail in the middle of the
+    pipeline with the error of whichever stage noticed first.
+
+    """
+    probe = _probe(env)
+    for name, kind, formats in (("--from", "input", probe.input_formats),
+                                ("--to", "output", probe.output_formats)):
+        for value in _values(options, name)[-1:] + ["json"]:
+            format = re.match(r"[^+-]*", value).group(0)
+            if format.endswith(".lua") or format in formats:
+                continue
+
+            raise SCons.Errors.UserError(
+                    "{0} does not support the {1} format '{2}'; see "
+                    "'pandoc --list-{1}-formats'".format(
+                        probe.banner, kind, format
+                    )
+                )
+
+
+_Plan = collections.namedtuple(
+        "_Plan", ["files", "stages", "key", "images", "bibliography",
+                  "server", "request", "shared", "timeout", "engine",
+                  "fast", "resources"]
+    )
+
+
+def _plan(node, env):
+    """Plan the scan of a target without running the pipeline
+
+    This does all of the work for :func:`_scanner` that does not require
+    running Pandoc on the document.
+
+    Returns
+    -------
+
+    plan: :class:`_Plan`
+        The ``files`` from the command line flags, the ``stages`` of the
+        scan pipeline, the scan cache ``key`` or None if nothing needs to
+        be run, whether ``images`` are dependencies, whether the
+        ``bibliography`` was given on the command line, the ``server``
+        URL and ``request`` if the Pandoc server can run the scan,
+        whether the first stage is ``shared`` with other targets, the
+        ``timeout`` of each stage, the scan ``engine``, and the mode,
+        sources, and metadata files for the Markdown ``fast`` path or
+        None if it cannot be used, and the ``resources`` directories to
+        search for the files in the document
+
+    """
+    logger = logging.getLogger(__name__ + ".scanner")
+    # Grab the base command SCons will run.  This does assume the user
+    # did not override the command variable and hard code the output.
+    options = _command_line(env.subst_target_source("$PANDOCCOM"))
+    node_sources = node.sources
+
+    # The settings of defaults files are spliced into the command.
+    datadir = (_values(options, "--data-dir") or [None])[-1]
+    options, defaults = _with_defaults(options, datadir, env)
+    _check_formats(options, env)
+    logger.debug("initial command: '{0}'".format(
+            " ".join(y for x in options for y in x.args)
+        ))
+    # Now find the options with files that are needed to generate the
+    # final document.  But, we want to make sure the file is actually in
+    # the build tree and not simply an installed executable or file.  We
+    # do not want to deal with searching all over creation so we do not
+    # deal with the data directory.  The --resource-path flag is used to
+    # find the files in the document.
+    arguments = (
+            "--filter",
+            "--lua-filter",
+            "--metadata-file",
+            "--abbreviations",
+            "--highlight-style",
+            "--syntax-definition",
+            "--include-in-header",
+            "--include-before-body",
+            "--include-after-body",
+            "--css",
+            "--reference-doc",
+            "--epub-cover-image",
+            "--epub-metadata",
+            "--epub-embed-font",
+            "--bibliography",
+            "--csl",
+            "--citation-abbreviations",
+        )
+    files = []
+    for name in arguments:
+        files.extend([env.File(x) for x in _values(options, name)
+                      if os.path.exists(x)])
+
+    # The target format in case it was specified as this overrides the
+    # output format.  We also need the data directory for finding
+    # installed filters and defaults files.  The last flag wins.
+    to = (_values(options, "--to") or [None])[-1]
+    datadir = (_values(options, "--data-dir") or [None])[-1]
+    files.extend([env.File(x) for x in defaults])
+
+    # The included files can pull in more files of their own.
+    included = _included([x.path for x in files])
+    files.extend([env.File(x) for x in included])
+
+    # Now we need to determine the files inside the document that will
+    # influence the output.  To do this, we need to analyze the tree
+    # Pandoc will write out after all of the filters have been run.  The
+    # best parser for a Pandoc document is Pandoc itself; however, we
+    # want to interrupt the processing before the Writer is called.
+    # Looking at the filter documentation, we can achieve this by
+    # calling Pandoc with the appropriate flags and piping the JSON
+    # output through each filter.  The output format is passed as an
+    # argument to each filter so we must replicate that behavior to
+    # ensure the syntax tree has the final files.
+    #
+    # If the user provided the ``--to`` flag (with possible extensions),
+    # that _is_ the output format.  Otherwise, we take the format from
+    # the file extension.  The only exception is the 'beamer' output.
+    format = _format(to, node)
+
+    # Now that we have the format, we can figure out if the template was
+    # defined and inside the project.  First, we need the root of the
+    # build and the template.
+    template = (_values(options, "--template") or ["default"])[-1]
+    # Add the extension if needed.
+    _, ext = os.path.splitext(template)
+    if ext == "":
+        template = template + "." + format
+
+    # First, check that the file exists or is findable in the data
+    # directory.
+    if not os.path.exists(template):
+        if datadir:
+            template = os.path.join(datadir, "templates", template)
+
+    if os.path.exists(template) and format not in ("docx", "pptx"):
+        files.append(env.File(template))
+
+    # The user can declare the files a filter depends on or contributes
+    # to the document.  These are dependencies whether or not the
+    # filter runs during the scan.
+    mode = env.subst("$PANDOCSCANMODE") or "full"
+    if mode not in ("full", "reader", "declared"):
+        raise SCons.Errors.UserError(
+                "Invalid PANDOCSCANMODE '{0}'; expected 'full', 'reader', "
+                "or 'declared'".format(mode)
+            )
+
+    fast = env.subst("$PANDOCSCANFAST") or "off"
+    if fast not in ("off", "auto", "verify"):
+        raise SCons.Errors.UserError(
+                "Invalid PANDOCSCANFAST '{0}'; expected 'off', 'auto', or "
+                "'verify'".format(fast)
+            )
+
+    engine = env.subst("$PANDOCSCANENGINE") or "threads"
+    if engine not in ("threads", "asyncio"):
+        raise SCons.Errors.UserError(
+                "Invalid PANDOCSCANENGINE '{0}'; expected 'threads' or "
+                "'asyncio'".format(engine)
+            )
+
+    # The converted bibliographies need the cited keys from the scan but
+    # not the formatted citations so the scan leaves out citeproc and
+    # the fast path that cannot find the citations.
+    citeproc = bool(env.get("PANDOCBIBJSON")) and any(
+            x.name == "--citeproc" for x in options
+        )
+    if citeproc:
+        fast = "off"
+
+    declared = env.get("PANDOCFILTERDEPS") or {}
+    neutral = env.Split(env.get("PANDOCSCANNEUTRAL") or [])
+    neutral = [env.subst(x) for x in neutral]
+    for filt in _values(options, "--filter") + \
+            _values(options, "--lua-filter"):
+        deps = _marked(filt, declared)
+        if deps is not None:
+            files.extend([env.File(env.subst(x)) for x in env.Split(deps)])
+
+    # We need to run each filter in order; however, we also need to
+    # run any Lua filters in their proper location.  We can do this
+    # by reading from the front of the command until we find a
+    # filter.  Only the filters Pandoc runs itself (Lua filters and
+    # citeproc) depend on their position.  Every other option is applied
+    # by Pandoc before any filter runs so it goes to the reader.  The
+    # consecutive in-process filters are merged so each run between
+    # JSON filters costs a single Pandoc process.  We start by
+    # processing the input files.
+    reader = []
+    stages = []
+    pending = []
+    # Lua filters are found like JSON filters, including in the data
+    # directory, so the scan cache key covers the file Pandoc runs.
+    scripts = [_find_filter(x, datadir, env)[-1]
+               for x in _values(options, "--lua-filter")] + defaults
+    cmd0 = [_detect(env), "--from", "json", "--to", "json"] + (
+        ["--data-dir={0}".format(datadir)] if datadir else []
+    )
+    sources = [x for x in node_sources if os.path.exists(x.path)]
+    paths = [x.path for x in sources]
+
+    # The intermediate stages of :func:`_PandocStaged` only need the
+    # files from the command line; their target does the scanning.
+    if getattr(node.attributes, "pandoc_stage", False):
+        sources = []
+
+    # A syntax tree made by :func:`_PandocMulti` may not exist yet and
+    # is shared by every format.  Its reader replaces ours so the
+    # sources are parsed once for all of the targets.
+    shared = None
+    if len(node_sources) == 1 and \
+            getattr(node_sources[0].attributes, "pandoc_ast", False):
+        ast = node_sources[0]
+        shared = _plan(ast, ast.get_build_env()).stages[:1]
+        sources = [x for x in ast.sources if os.path.exists(x.path)]
+        if not shared:
+            sources = []
+
+    def flush():
+        """Add the pending in-process filters to the pipeline"""
+        if pending:
+            if stages or shared:
+                stages.append(cmd0 + pending)
+            else:
+                reader.extend(pending)
+
+            del pending[:]
+
+    for option in options if sources else ():
+        # The output and its format are replaced by the syntax tree.
+        # The extracted media and the log are outputs of the build and
+        # the scan needs the original files.  The diagnostics would only
+        # bury the error output of a failed stage.
+        if option.name in ("--output", "--to", "--extract-media", "--log",
+                           "--verbose", "--trace"):
+            continue
+
+        # Is this a filter Pandoc runs in process?
+        if option.name in ("--lua-filter", "--citeproc"):
+            if not (citeproc and option.name == "--citeproc"):
+                pending.extend(option.args)
+
+            continue
+
+        # Determine if it is a filter
+        if option.name == "--filter" and option.value:
+            filt = option.value
+            logger.debug("filt: '{0}'".format(filt))
+
+            # Filters that cannot add dependencies are left out of the
+            # pipeline unless the user asked for the full chain.  In
+            # 'reader' mode, that is every JSON filter.
+            if mode == "reader" or (mode == "declared" and (
+                    _marked(filt, neutral) is not None
+                    or _marked(filt, declared) is not None)):
+                logger.debug("skip: '{0}'".format(filt))
+                continue
+
+            # First, deal with any intervening filters and then figure
+            # out the filter.
+            flush()
+            with _profile.timer("filter_lookup_seconds"):
+                cmd_ = _find_filter(filt, datadir, env)
+
+            scripts.append(cmd_[-1])
+            stages.append(cmd_ + [format])
+        else:
+            # Otherwise, it is an option for the reader.
+            reader.extend(option.args)
+
+    # Now process any filters after the last JSON filter and put the
+    # reader at the front of the pipeline.
+    flush()
+    # Plain Markdown read by Pandoc without any filter that can change
+    # the syntax tree can be tokenized directly.
+    if fast != "off" and reader and not stages and not shared \
+            and _fast_plan(reader, paths,
+                           _values(options, "--metadata-file")):
+        fast = (fast, paths, _values(options, "--metadata-file"))
+    else:
+        fast = None
+
+    if shared and sources:
+        stages[0:0] = shared
+    elif reader:
+        stages.insert(0, reader + ["--to", "json"] + paths)
+
+    # For images, we only concern ourselves with outputs that are a
+    # final stage.  This includes formats such as 'docx', 'pptx',
+    # 'html', and 'epub'.  It excludes 'markdown' and 'latex'.  The
+    # rationale is these are not delivery formats and, therefore, still
+    # need to be processed as another stage in SCons.  That is when the
+    # scanning needs to be done.  We also exclude PDF because SCons has
+    # a better scanner built in. (And why would you want to use SCons if
+    # you just want to use Pandoc to go straight to PDF?)
+    skip = (
+            "asciidoc",
+            "commonmark",
+            "context",
+            "gfm",
+            "json",
+            "latex",
+            "markdown",
+            "markdown_mmd",
+            "markdown_phpextra",
+            "markdown_strict",
+            "native",
+            "org",
+            "plain",
+            "rst",
+            "tex",
+        )
+
+    key = None
+    if stages:
+        key = _scan_key(env, stages, sources, scripts, format,
+                        _values(options, "--metadata-file") + included,
+                        fast[0] if fast else "off")
+
+    # The syntax tree itself shares its reader with its outputs.  The
+    # server can only run the reader.
+    shared = bool(shared) or getattr(node.attributes, "pandoc_ast", False)
+    server = _server(env) if len(stages) == 1 and not shared else None
+    request = _server_request(stages[0][1:])[0] if server else None
+    timeout = float(env.subst("$PANDOCSCANTIMEOUT") or 0) or None
+    # Later flags are searched first and the working directory last.
+    resources = [y for x in reversed(_values(options, "--resource-path"))
+                 for y in x.split(os.pathsep) if y] + ["."]
+    return _Plan(files, stages, key, format not in skip,
+                 bool(_values(options, "--bibliography")), server, request,
+                 shared, timeout, engine, fast, resources)
+
+
+def _execute(plan):
+    """Run the scan of a plan
+
+    The Markdown fast path runs first if the plan allows it and, unless
+    it is verifying, its result is final.  The Pandoc server runs the
+    scan if the plan allows it.  Otherwise, or if the server fails, the
+    pipeline is run on the command line by the scan engine of the plan.
+
+    """
+    if plan.engine == "asyncio":
+        return _run_async(_execute_async(plan))
+
+    fast = _fast_scan(plan)
+    if fast is not None and plan.fast[0] == "auto":
+        return fast
+
+    return _fast_verify(plan, fast, _server_scan(plan) or _run_scan(
+            plan.stages, plan.images, plan.shared, plan.timeout
+        ))
+
+
+def _run_async(coro):
+    """Run a coroutine of the asyncio scan engine
+
+    SCons only notes an interrupt while it builds, so the coroutine is
+    cancelled on an interrupt, which kills and reaps its processes, and
+    :class:`KeyboardInterrupt` is raised.
+
+    """
+    import asyncio
+
+    interrupted = []
+
+    async def main():
+        task = asyncio.current_task()
+        loop = asyncio.get_event_loop()
+        previous = signal.getsignal(signal.SIGINT)
+
+        def interrupt():
+            interrupted.append(True)
+            task.cancel()
+
+        try:
+            loop.add_signal_handler(signal.SIGINT, interrupt)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not the main thread or not supported on this platform.
+            previous = None
+
+        try:
+            return await coro
+        finally:
+            if previous is not None:
+                loop.remove_signal_handler(signal.SIGINT)
+                signal.signal(signal.SIGINT, previous)
+
+    try:
+        return asyncio.run(main())
+    except asyncio.CancelledError:
+        if interrupted:
+            raise KeyboardInterrupt
+
+        raise
+
+
+async def _execute_async(plan, slots=None):
+    """Run the scan of a plan like :func:`_execute` with :mod:`asyncio`
+    """
+    import asyncio
+
+    fast = _fast_scan(plan)
+    if fast is not None and plan.fast[0] == "auto":
+        return fast
+
+    result = None
+    if plan.server and plan.request:
+        result = await asyncio.get_event_loop().run_in_executor(
+                None, _server_scan, plan
+            )
+
+    return _fast_verify(plan, fast, result or await _run_scan_async(
+            plan.stages, plan.images, plan.shared, plan.timeout, slots
+        ))
+
+
+def _server_scan(plan):
+    """Run the scan of a plan on the Pandoc server
+
+    Returns
+    -------
+
+    result: dict or None
+        The result of the scan or None if the server cannot run it
+
+    """
+    if plan.server and plan.request:
+        logger = logging.getLogger(__name__ + ".server")
+        try:
+            output, _ = _server_convert(plan.server, plan.request,
+                                        plan.timeout)
+            return _extract(io.BytesIO(output.encode("utf-8")),
+                            plan.images)
+        except (OSError, ValueError) as err:
+            logger.debug("failed: {0}".format(err))
+
+    return None
+
+
+def _scanner(node, env, path, arg=None):
+    """ Attempt to scan the final target for images and bibliographies
+
+    In Pandoc flavored MarkDown, the only "included" files are the
+    images and the bibliographies.  We need to tell SCons about these,
+    but we don't want to do this by hand.  To do this, we directly use
+    Pandoc's json output and analyze the document tree for the images
+    and the metadata for bibliographies.  We need to operate on the
+    filtered syntax tree so we can get the final filtered version.  The
+    logic should work on any input format Pandoc can translate into its
+    AST.
+
+    Note you must respect Pandoc's bibliography file rules.  The command
+    line arguments will override files specified in the YAML block of
+    the header file.
+
+    This logic is primarily aimed at the MarkDown sources, but it should
+    work with the other plain text sources too.  However, this is not
+    rigorously tested.  For LaTeX sources, you should really just use
+    the SCons builder to have the right thing done.
+
+    """
+    logger = logging.getLogger(__name__ + ".scanner")
+    # The other outputs share the dependencies of the document.
+    if getattr(node.attributes, "pandoc_secondary", False):
+        return []
+
+    _check(env)
+    _profile.enable(env)
+    _prescan_pending(env)
+    with _profile.target(node):
+        return _scan(node, env, logger)
+
+
+def _scan(node, env, logger):
+    """Scan a target for :func:`_scanner`"""
+    _profile.add("scans")
+    with _profile.timer("plan_seconds"):
+        plan = _plan(node, env)
+
+    files = plan.files
+
+    # Running the pipeline is the expensive part of the scan so we
+    # consult the scan cache before launching anything.  The key covers
+    # everything that can change the filtered syntax tree.
+    result = None
+    if plan.key:
+        cache = _scan_cache(env)
+        result = cache.get(plan.key)
+        if result is None:
+            result = _execute(plan)
+            cache.put(plan.key, result)
+        else:
+            logger.debug("cached: '{0}'".format(plan.key))
+            _profile.add("cached")
+
+    # Chunked HTML is next to its directory.
+    output = getattr(node.attributes, "pandoc_output", None) or node
+    root = os.path.dirname(str(output))
+    resources = [env.Dir(x) for x in plan.resources]
+
+    def _path(x):
+        """A helper for getting the path right
+
+        The file is looked for next to the target and then in each
+        directory of the resource path.  SCons caches the listing of
+        each directory so each lookup is a dictionary access.  A file
+        that is not found is assumed to be next to the target.
+
+        """
+        if os.path.commonprefix([root, x]) == root:
+            path = env.File(x)
+        else:
+            path = env.File(os.path.join(root, x))
+
+        if os.path.isabs(x):
+            return path
+
+        return SCons.Node.FS.find_file(path.name, (path.dir,)) \
+            or SCons.Node.FS.find_file(x, resources) or path
+
+    # Remote images are fetched by Pandoc and cannot be tracked.
+    images = []
+    if result and plan.images:
+        images = [x for x in result["images"]
+                  if x and not re.match(r"[a-z][-+.a-z0-9]+:", x, re.I)]
+        logger.debug("images: {0}".format(images))
+        images = [(x, _path(x)) for x in images]
+        files.extend([x for _, x in images])
+
+    # And, finally, check the metadata for a bibliography file
+    if result:
+        if not plan.bibliography:
+            files.extend([_path(x) for x in result["bibliography"]])
+
+    # SCons scans a target before its generated sources exist.  That
+    # scan finds nothing so what is made from the scan is left for the
+    # scan of the complete sources.
+    if not _complete(node, result):
+        logger.debug("{0!s}: {1!s}".format(node, [str(x) for x in files]))
+        return files
+
+    # Without images Pandoc has no media to extract so the targets can
+    # be cached.
+    if getattr(node.attributes, "pandoc_media", False) and \
+            plan.images and not result["images"]:
+        for target in node.get_executor().get_all_targets():
+            target.set_nocache(False)
+
+    # The document is built with the cited entries of the converted
+    # bibliographies so those replace the originals.
+    refs, bibs = _bibjson(node, env, result, _path)
+    if refs is not None:
+        files = [x for x in files if x not in bibs] + [refs]
+
+    # Likewise for the derived images and the filter that uses them.
+    derived, originals = _derive(node, env, images)
+    if derived:
+        files = [x for x in files if x not in originals] + derived
+
+    logger.debug("{0!s}: {1!s}".format(node, [str(x) for x in files]))
+    return files
+
+
+def _complete(node, result):
+    """Whether a scan saw every source of a target
+
+    Returns
+    -------
+
+    complete: bool
+        True if the scan has a result and every source exists
+
+    """
+    return result is not None and all(x.rexists() for x in node.sources)
+
+
+def _beside(node, suffix):
+    """The file named by the output of a target and ``suffix``
+
+    The directory of chunked HTML is replaced by Pandoc so the file is
+    put next to it.
+
+    """
+    output = getattr(node.attributes, "pandoc_output", None) or node
+    return output.dir.File(output.name + suffix)
+
+
+# The CSL-JSON conversion of each bibliography.
+_bibliographies = {}
+_bibliography_readers = (".bib", ".bibtex", ".json")
+
+
+def _bibjson(node, env, result, resolve):
+    """Convert the bibliographies of a target to CSL-JSON
+
+    If ``$PANDOCBIBJSON`` is set and the target runs citeproc, each
+    BibTeX bibliography is converted once per build into CSL-JSON by
+    ``$PANDOCBIBCOM`` and the entries cited by the target are written to
+    the target name with ``$PANDOCBIBSUFFIX``.  The bibliographies from
+    the command line or, if none were given, from the metadata are
+    replaced.  Nothing is replaced if a defaults file sets the
+    bibliography, a bibliography is not BibTeX or CSL-JSON, or the
+    citations are not known.  The ``resolve`` function finds the files
+    named in the metadata.
+
+    Returns
+    -------
+
+    refs: :class:`SCons.Node.FS.File` or None
+        The cited entries the target is built with
+
+    bibliographies: list
+        The bibliographies that were replaced
+
+    """
+    converted = getattr(node.attributes, "pandoc_bibjson", None)
+    if converted is not None:
+        return converted
+
+    node.attributes.pandoc_bibjson = (None, [])
+    if not env.get("PANDOCBIBJSON") or not result \
+            or result.get("citations") is None \
+            or getattr(node.attributes, "pandoc_stage", False):
+        return node.attributes.pandoc_bibjson
+
+    options = _command_line(env.subst_target_source("$PANDOCCOM"))
+    datadir = (_values(options, "--data-dir") or [None])[-1]
+    spliced, _ = _with_defaults(options, datadir, env)
+    bibs = _values(options, "--bibliography")
+    if not any(x.name == "--citeproc" for x in spliced) \
+            or _values(spliced, "--bibliography") != bibs:
+        return node.attributes.pandoc_bibjson
+
+    if bibs:
+        bibs = [env.File(x) for x in bibs]
+    else:
+        bibs = [resolve(x) for x in result["bibliography"]]
+
+    if not bibs or any(os.path.splitext(x.name)[1].lower()
+                       not in _bibliography_readers for x in bibs):
+        return node.attributes.pandoc_bibjson
+
+    suffix = env.subst("$PANDOCBIBSUFFIX")
+    data = []
+    for bib in bibs:
+        base, ext = os.path.splitext(bib.name)
+        if ext.lower() != ".json" and bib not in _bibliographies:
+            _bibliographies[bib] = env.Command(
+                    bib.dir.File(base + suffix), bib, _convert
+                )[0]
+
+        data.append(_bibliographies.get(bib, bib))
+
+    refs = env.Command(_beside(node, suffix), data, _cite,
+                       PANDOCBIBCITES=result["citations"])[0]
+    node.attributes.pandoc_bibjson = (refs, bibs)
+    return node.attributes.pandoc_bibjson
+
+
+# The derived images by content hash.
+_derivatives = {}
+# The formats that embed the images and need them relative to the build.
+_embedded = ("docx", "epub", "epub2", "epub3", "fb2", "odt", "pptx")
+
+
+def _derive(node, env, images):
+    """Derive the images of a target with the builders of their type
+
+    ``$PANDOCIMAGES`` maps the suffix of an image to the suffix of its
+    derivative and the action that makes it.  The derivative of each
+    source file in ``images``, a list of the URL and the file of each
+    image, is written to ``$PANDOCIMAGEDIR`` under the hash of the image
+    contents, the suffix, and the action so it is made once no matter
+    how many targets use it.  The URLs are rewritten by a Lua
+    filter written to the target name with ``$PANDOCIMAGEFILTERSUFFIX``
+    that runs after every other filter.
+
+    Returns
+    -------
+
+    derived: list
+        The derivatives and the filter the target is built with
+
+    images: list
+        The images that were replaced
+
+    """
+    derived = getattr(node.attributes, "pandoc_images", None)
+    if derived is not None:
+        return derived[1:]
+
+    node.attributes.pandoc_images = (None, [], [])
+    rules = env.get("PANDOCIMAGES") or {}
+    if not rules or not images or \
+            getattr(node.attributes, "pandoc_stage", False) or \
+            getattr(node.attributes, "pandoc_ast", False):
+        return node.attributes.pandoc_images[1:]
+
+    options = _command_line(env.subst_target_source("$PANDOCCOM"))
+    to = (_values(options, "--to") or [None])[-1]
+    embedded = _format(to, node) in _embedded or any(
+            x.name in ("--embed-resources", "--self-contained")
+            for x in options
+        )
+    root = env.Dir(env.subst("$PANDOCIMAGEDIR"))
+    mapping = []
+    derived = []
+    originals = []
+    for url, image in images:
+        rule = rules.get(image.suffix.lower())
+        if rule is None or image.has_builder() or not image.rexists():
+            continue
+
+        suffix, action = rule
+        key = hashlib.sha1("\0".join(
+                [image.get_csig(), suffix, str(action)]
+            ).encode("utf-8")).hexdigest()
+        if key not in _derivatives:
+            _derivatives[key] = env.Command(root.File(key + suffix), image,
+                                            action)[0]
+
+        path = _derivatives[key].path
+        if not embedded:
+            path = os.path.relpath(path, node.dir.path)
+
+        mapping.append([url, path.replace(os.sep, "/")])
+        derived.append(_derivatives[key])
+        originals.append(image)
+
+    if not mapping:
+        return node.attributes.pandoc_images[1:]
+
+    filt = env.Command(
+            _beside(node, env.subst("$PANDOCIMAGEFILTERSUFFIX")),
+            [], _images, PANDOCIMAGEMAP=sorted(mapping)
+        )[0]
+    node.attributes.pandoc_images = (filt, derived + [filt], originals)
+    return node.attributes.pandoc_images[1:]
+
+
+def _lua_string(text):
+    """Quote a string for Lua"""
+    return '"' + "".join(
+            c if c.isprintable() and c not in '"\\' else
+            "".join("\\{0:03d}".format(x) for x in c.encode("utf-8"))
+            for c in text
+        ) + '"'
+
+
+def _run_images(target, source, env):
+    """Write the Lua filter replacing the images of a target
+
+    The filter maps each URL to its derivative with the pairs in
+    ``$PANDOCIMAGEMAP``.
+
+    """
+    with open(target[0].abspath, "w", encoding="utf-8") as stream:
+        stream.write("local derived = {\n")
+        for url, path in env["PANDOCIMAGEMAP"]:
+            stream.write("  [{0}] = {1},\n".format(_lua_string(url),
+                                                   _lua_string(path)))
+
+        stream.write("}\n\n"
+                     "function Image(image)\n"
+                     "  local path = derived[image.src]\n"
+                     "  if path then\n"
+                     "    image.src = path\n"
+                     "    return image\n"
+                     "  end\n"
+                     "end\n")
+
+    return 0
+
+
+def _run_images_string(target, source, env):
+    return env.subst("$PANDOCIMAGEFILTERCOMSTR", target=target,
+                     source=source) \
+        or env.subst("images > $TARGET", target=target, source=source)
+
+
+_images = SCons.Action.Action(_run_images, _run_images_string,
+                              varlist=["PANDOCIMAGEMAP"])
+
+
+# The parsed CSL-JSON bibliographies by path.
+_csl = {}
+
+
+def _cite_entries(path):
+    """Load a CSL-JSON bibliography once for every target citing it"""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _csl.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, encoding="utf-8") as stream:
+            cached = _csl[path] = (stamp, json.load(stream))
+
+    return cached[1]
+
+
+def _run_cite(target, source, env):
+    """Write the entries of the CSL-JSON sources cited by a target
+
+    The keys are in ``$PANDOCBIBCITES`` where ``*`` cites every entry.
+    The first entry with a key wins like it does in Pandoc.
+
+    """
+    cites = set(env["PANDOCBIBCITES"])
+    seen = set()
+    entries = []
+    for node in source:
+        for entry in _cite_entries(node.abspath):
+            key = entry.get("id")
+            if key not in seen and ("*" in cites or key in cites):
+                seen.add(key)
+                entries.append(entry)
+
+    with open(target[0].abspath, "w", encoding="utf-8") as stream:
+        json.dump(entries, stream, ensure_ascii=False, indent=1)
+
+    return 0
+
+
+def _run_cite_string(target, source, env):
+    return env.subst("$PANDOCCITECOMSTR", target=target, source=source) \
+        or env.subst("cite $SOURCES > $TARGET", target=target,
+                     source=source)
+
+
+_convert = SCons.Action.Action("$PANDOCBIBCOM", "$PANDOCBIBCOMSTR")
+_cite = SCons.Action.Action(_run_cite, _run_cite_string,
+                            varlist=["PANDOCBIBCITES"])
+
+
+_targets = []
+_documents = []
+
+
+def _emitter(target, source, env):
+    """Record the Pandoc targets and declare the other outputs of Pandoc
+
+    The command and its defaults files are read like the scanner does.
+    The ``--log`` file is another target.  Chunked HTML written to a
+    directory is replaced by the ``index.html`` and ``sitemap.json``
+    Pandoc always writes there.  The directory given by
+    ``--extract-media`` is declared a side effect of the targets so
+    builds writing to it do not run at the same time.  These
+    directories are removed when the targets are cleaned.  The other
+    files of chunked HTML are named by Pandoc so those targets are not
+    cached as the cache could only restore part of the output.  The
+    same goes for extracted media but it is only known once the targets
+    are scanned whether there is any.
+
+    The SConscript files are read before anything is built so Pandoc is
+    not run and only the defaults files given by their path are read.
+    A command that cannot be parsed leaves the targets as they are for
+    the build to report.
+
+    """
+    # Only the flags are needed so Pandoc is not looked for yet.
+    if env.get("PANDOC") == _pandoc_default:
+        env = env.Override({"PANDOC": "pandoc"})
+
+    def parse(**kw):
+        """Parse the command with the settings of the defaults files"""
+        try:
+            options = _command_line(env.subst("$PANDOCCOM", **kw))
+            datadir = (_values(options, "--data-dir") or [None])[-1]
+            return _with_defaults(options, datadir, env, search=False)[0]
+        except Exception:
+            return ()
+
+    # Expanding the targets would make them files before it is known
+    # which are directories.
+    to = (_values(parse(), "--to") or [None])[-1]
+    outputs = []
+    directories = []
+    for node in target:
+        if _format(to, node) == "chunkedhtml" and \
+                not os.path.splitext(node.name)[1]:
+            node = env.Dir(node)
+            directories.append(node)
+            outputs.append(node.File("index.html"))
+            outputs[-1].attributes.pandoc_output = node
+            outputs.append(node.File("sitemap.json"))
+            outputs[-1].attributes.pandoc_secondary = True
+        else:
+            outputs.append(env.File(node))
+
+    documents = [x for x in outputs
+                 if not getattr(x.attributes, "pandoc_secondary", False)]
+    _targets.extend(documents)
+    if SCons.Script.GetOption("pandoc_watch"):
+        _documents.extend(documents)
+    options = parse(target=outputs, source=source)
+    for log in _values(options, "--log"):
+        outputs.append(env.File(log))
+        outputs[-1].attributes.pandoc_secondary = True
+
+    media = _values(options, "--extract-media")
+    for path in media:
+        env.SideEffect(path, outputs)
+
+    if directories or media:
+        env.Clean(outputs, directories + media)
+        env.NoCache(outputs)
+
+    # The scan lifts this if there are no media to extract.
+    if media and not directories:
+        for node in documents:
+            node.attributes.pandoc_media = True
+
+    return outputs, source
+
+
+def _prescan(nodes, jobs):
+    """Scan the given targets concurrently to fill the scan cache
+
+    The scans are planned in the calling thread because computing the
+    content signatures touches the SCons Nodes.  Only the pipelines are
+    run by a pool of ``jobs`` threads or, for the asyncio engine, all at
+    once with at most ``jobs`` processes.  Targets sharing a scan cache
+    key are run once.  A failed scan is left for :func:`_scanner` to
+    repeat and report.
+
+    """
+    logger = logging.getLogger(__name__ + ".prescan")
+    pending = collections.OrderedDict()
+    for node in nodes:
+        env = node.get_build_env()
+        _check(env)
+        _profile.enable(env)
+        with _profile.target(node), _profile.timer("plan_seconds"):
+            plan = _plan(node, env)
+
+        if not plan.key:
+            continue
+
+        cache = _scan_cache(env)
+        if cache.get(plan.key) is None:
+            pending.setdefault((id(cache), plan.key), (node, cache, plan))
+
+    if not pending:
+        return
+
+    logger.debug("scanning {0} targets with {1} jobs"
+                 .format(len(pending), jobs))
+
+    def execute(node, plan):
+        """Run the scan for the profile of ``node``"""
+        with _profile.target(node):
+            return _execute(plan)
+
+    scans = [x for x in pending.values() if x[2].engine == "asyncio"]
+    for cache, key, result in _run_async(_prescan_async(scans, jobs)) \
+            if scans else []:
+        if isinstance(result, Exception):
+            logger.debug("failed: '{0}': {1}".format(key, result))
+        else:
+            cache.put(key, result)
+
+    scans = [x for x in pending.values() if x[2].engine != "asyncio"]
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+        futures = {
+                pool.submit(execute, node, plan):
+                (cache, plan.key)
+                for node, cache, plan in scans
+            }
+        for future in concurrent.futures.as_completed(futures):
+            cache, key = futures[future]
+            try:
+                cache.put(key, future.result())
+            except Exception as err:
+                logger.debug("failed: '{0}': {1}".format(key, err))
+
+
+async def _prescan_async(scans, jobs):
+    """Run the scans of :func:`_prescan` with the asyncio engine
+
+    The ``scans`` are the node, scan cache, and plan of each target.
+    Every scan is started at once but at most ``jobs`` processes run at
+    a time.  Interrupting the build cancels the scans and reaps their
+    processes.
+
+    Returns
+    -------
+
+    results: list
+        The scan cache, key, and result or exception of each scan
+
+    """
+    import asyncio
+
+    slots = _Slots(jobs)
+
+    async def execute(node, plan):
+        with _profile.target(node):
+            return await _execute_async(plan, slots)
+
+    results = await asyncio.gather(
+            *[execute(node, plan) for node, _, plan in scans],
+            return_exceptions=True
+        )
+    return [(cache, plan.key, result)
+            for (_, cache, plan), result in zip(scans, results)]
+
+
+def _prescan_pending(env):
+    """Prescan the registered targets if ``$PANDOCSCANJOBS`` asks for it
+
+    Only the targets that are part of the build are scanned.  The others
+    are forgotten as the scanner prescans once per build.
+
+    """
+    jobs = int(env.subst("$PANDOCSCANJOBS") or 0)
+    if jobs > 1 and _targets:
+        nodes = _requested(env, _targets)
+        del _targets[:]
+        _prescan(nodes, jobs)
+
+
+def _requested(env, nodes):
+    """Select the Nodes that SCons was asked to build
+
+    Like SCons, the build is of ``BUILD_TARGETS`` or else the top
+    directory.  A Node is part of it if a Node of the build depends on
+    it before anything is scanned or it is under a directory of the
+    build.  The names on the command line are looked up from the top
+    directory so ``-u`` and its relatives may miss a few Nodes, which
+    are then scanned as they are built.
+
+    Returns
+    -------
+
+    nodes: list
+        The given Nodes that are built in the given order
+
+    """
+    top = env.arg2nodes(list(SCons.Script.BUILD_TARGETS) or ["#"],
+                        env.fs.Entry)
+    seen = set()
+    directories = []
+    while top:
+        node = top.pop()
+        if node in seen:
+            continue
+
+        seen.add(node)
+        if isinstance(node, SCons.Node.FS.Dir):
+            directories.append(node)
+
+        top.extend(node.all_children(scan=0))
+
+    return [x for x in nodes if x in seen or
+            any(x.is_under(y) for y in directories)]
+
+
+def _PandocPrescan(env, target=None, jobs=None):
+    """Scan Pandoc targets concurrently before the build starts
+
+    The ``target`` defaults to every target of the ``Pandoc`` builder
+    defined so far and ``jobs`` defaults to ``$PANDOCSCANJOBS`` or the
+    number of processors.  The results are stored in the scan cache so
+    the scanner does not need to run the pipelines again.
+
+    """
+    if target is None:
+        nodes = list(_targets)
+        del _targets[:]
+    else:
+        nodes = env.arg2nodes(target, env.fs.Entry)
+
+    if jobs is None:
+        jobs = int(env.subst("$PANDOCSCANJOBS") or 0) or os.cpu_count()
+
+    _prescan(nodes, jobs)
+
+
+def _strip_flags(flags, names):
+    """Remove options from the command line flags
+
+    The ``names`` are the long names of the options.  Every spelling
+    :func:`_tokenize` recognizes is removed.
+
+    """
+    return [y for x in _tokenize(SCons.Util.CLVar(flags))
+            if x.name not in names for y in x.args]
+
+
+def _reader_flags(flags):
+    """The flags for reading the syntax tree of :func:`_PandocMulti`
+
+    The filters are left for the writers because they depend on the
+    output format.
+
+    """
+    return _strip_flags(flags, ("--filter", "--lua-filter", "--citeproc"))
+
+
+def _writer_flags(flags):
+    """The flags for writing the syntax tree of :func:`_PandocMulti`
+
+    The input format is replaced by JSON and the options the reader
+    already applied that would change the document again are removed.
+
+    """
+    return _strip_flags(flags, (
+            "--from", "--shift-heading-level-by", "--base-header-level",
+            "--extract-media", "--file-scope",
+        ))
+
+
+def _targets_of(env, target, formats):
+    """Get the target Nodes of a pseudo-builder with ``formats``"""
+    if formats is not None:
+        base = env.subst(str(SCons.Util.flatten([target])[0]))
+        target = ["{0}.{1}".format(base, x) for x in env.Split(formats)]
+
+    return env.arg2nodes(target, env.fs.File)
+
+
+def _PandocMulti(env, target, source, formats=None, **kw):
+    """Convert the sources to several outputs while parsing them once
+
+    The ``source`` is read into a syntax tree named after the first
+    target with ``$PANDOCASTSUFFIX``, and every target is written from
+    that tree.  If ``formats`` is given, ``target`` is the base name of
+    the outputs and the formats are their extensions.  The remaining
+    keyword arguments are passed to each ``Pandoc`` call.
+
+    Returns
+    -------
+
+    targets: list
+        The Nodes of the outputs
+
+    """
+    targets = _targets_of(env, target, formats)
+    name = os.path.splitext(targets[0].name)[0]
+    ast = env.Pandoc(targets[0].dir.File(name + env.subst("$PANDOCASTSUFFIX")),
+                     source, PANDOCCOM="$PANDOCASTCOM", **kw)
+    for node in ast:
+        node.attributes.pandoc_ast = True
+
+    result = []
+    for node in targets:
+        result.extend(env.Pandoc(node, ast, PANDOCCOM="$PANDOCWRITECOM",
+                                 **kw))
+
+    return result
+
+
+def _run_filter(target, source, env):
+    """Run a JSON filter on the syntax tree of a stage
+
+    The filter ``$PANDOCFILTER`` is found and called the way Pandoc does
+    with the output format ``$PANDOCFORMAT`` as its argument.
+
+    """
+    filt = env.subst("$PANDOCFILTER")
+    cmd = _find_filter(filt, env.subst("$PANDOCDATADIR"), env)
+    environ = dict((k, str(v)) for k, v in env["ENV"].items())
+    environ["PANDOC_VERSION"] = ".".join(str(x) for x in _probe(env).version)
+    with open(str(source[0]), "rb") as stdin, \
+            open(str(target[0]), "wb") as stdout:
+        return subprocess.call(cmd + [env.subst("$PANDOCFORMAT")],
+                               stdin=stdin, stdout=stdout, env=environ)
+
+
+def _run_filter_string(target, source, env):
+    return env.subst("$PANDOCFILTERCOMSTR", target=target, source=source) \
+        or env.subst("$PANDOCFILTER $PANDOCFORMAT < $SOURCE > $TARGET",
+                     target=target, source=source)
+
+
+_filter = SCons.Action.Action(
+        _run_filter, _run_filter_string,
+        varlist=["PANDOCFILTER", "PANDOCFORMAT", "PANDOCDATADIR"]
+    )
+
+
+def _PandocStaged(env, target, source, formats=None, **kw):
+    """Convert the sources through a chain of tracked syntax trees
+
+    This works like :func:`_PandocMulti` except the filter chain is also
+    split into stages.  Each JSON filter and each run of citeproc before
+    the first Lua filter writes its own syntax tree with
+    ``$PANDOCASTSUFFIX``.  Only the stages after a change are run again
+    and the trees can be shared with ``CacheDir``.  A stage writes JSON
+    so a Lua filter in it would see 'json' as its ``FORMAT``.  The Lua
+    filters and every filter after the first of them are run by the
+    writer instead.  The outputs are scanned from the last tree.
+
+    Returns
+    -------
+
+    targets: list
+        The Nodes of the outputs
+
+    """
+    targets = _targets_of(env, target, formats)
+    overrides = env.Override(kw)
+
+    # Split the flags into the options, the groups of filters, and the
+    # filters of the writer.  A group is either a JSON filter or
+    # consecutive runs of citeproc.
+    options = []
+    groups = []
+    writer = []
+    datadir = ""
+    to = None
+    for option in _command_line(overrides.subst("$PANDOCFLAGS")):
+        if option.name in ("--filter", "--lua-filter", "--citeproc") and \
+                (writer or option.name == "--lua-filter"):
+            writer.extend(option.args)
+        elif option.name == "--filter":
+            groups.append(("filter", option.value))
+        elif option.name == "--citeproc":
+            if not groups or groups[-1][0] != "in-process":
+                groups.append(("in-process", []))
+
+            groups[-1][1].extend(option.args)
+        else:
+            if option.name == "--to":
+                to = option.value
+            elif option.name == "--data-dir":
+                datadir = option.value
+
+            options.extend(option.args)
+
+    common = _writer_flags(_strip_flags(options, ("--to", "--output")))
+    if groups and groups[-1][0] == "in-process":
+        writer = groups.pop()[1] + writer
+
+    options.extend(writer)
+
+    name = os.path.splitext(targets[0].name)[0]
+    ast = env.Pandoc(targets[0].dir.File(name + ".0" +
+                                         env.subst("$PANDOCASTSUFFIX")),
+                     source, PANDOCCOM="$PANDOCASTCOM", **kw)
+    for node in ast:
+        node.attributes.pandoc_stage = True
+
+    result = []
+    for node in targets:
+        format = _format(to, node)
+        stage = ast
+        for idx, (kind, value) in enumerate(groups, 1):
+            path = node.dir.File("{0}.{1}{2}".format(
+                    node.name, idx, env.subst("$PANDOCASTSUFFIX")
+                ))
+            if kind == "in-process":
+                stage = env.Pandoc(path, stage, **dict(
+                        kw, PANDOCCOM="$PANDOCSTAGECOM",
+                        PANDOCFLAGS=common + value
+                    ))
+                for x in stage:
+                    x.attributes.pandoc_stage = True
+            else:
+                stage = env.Command(path, stage, _filter, PANDOCFILTER=value,
+                                    PANDOCFORMAT=format,
+                                    PANDOCDATADIR=datadir)
+                if os.path.isfile(value):
+                    env.Depends(stage, env.File(value))
+
+        result.extend(env.Pandoc(node, stage, **dict(
+                kw, PANDOCCOM="$PANDOCWRITECOM", PANDOCFLAGS=options
+            )))
+
+    return result
+
+
+class _Inotify(object):
+    """Wait for changes to files with inotify
+
+    The directories of the files are watched so files replaced by
+    editors that save to a new file and rename it are still seen.
+
+    """
+    # IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE,
+    # and IN_DELETE.
+    mask = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    # Too many events were queued and some were lost.
+    overflow = 0x4000
+    # The directory was removed.
+    ignored = 0x8000
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.files = set()
+        self.dirs = {}
+
+    def add(self, paths):
+        """Watch the files in ``paths``"""
+        self.files.update(paths)
+        watched = set(self.dirs.values())
+        for root in set(os.path.dirname(x) for x in paths) - watched:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root),
+                                             self.mask)
+            if wd >= 0:
+                self.dirs[wd] = root
+
+    def read(self, timeout=None):
+        """Wait at most ``timeout`` seconds for changes
+
+        Returns
+        -------
+
+        paths: set
+            The paths of the files that changed
+
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        paths = set()
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, _, size = struct.unpack_from("iIII", data, pos)
+            name = data[pos + 16:pos + 16 + size].rstrip(b"\0")
+            pos += 16 + size
+            if mask & self.overflow:
+                paths.update(self.files)
+            elif mask & self.ignored:
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs and name:
+                paths.add(os.path.join(self.dirs[wd], os.fsdecode(name)))
+
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poll(object):
+    """Wait for changes to files by checking them every ``interval``"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.stats = {}
+
+    @staticmethod
+    def stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def add(self, paths):
+        """Watch the files in ``paths``"""
+        for path in paths:
+            if path not in self.stats:
+                self.stats[path] = self.stat(path)
+
+    def read(self, timeout=None):
+        """Wait at most ``timeout`` seconds for changes
+
+        Returns
+        -------
+
+        paths: set
+            The paths of the files that changed
+
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            paths = set()
+            for path, stat in self.stats.items():
+                current = self.stat(path)
+                if current != stat:
+                    self.stats[path] = current
+                    paths.add(path)
+
+            if paths or (end is not None and time.time() >= end):
+                return paths
+
+            time.sleep(self.interval if end is None
+                       else max(min(self.interval, end - time.time()), 0))
+
+    def close(self):
+        pass
+
+
+def _watcher(env):
+    """The watcher selected by ``$PANDOCWATCHBACKEND``
+
+    The ``auto`` backend uses inotify where it is available and polls
+    otherwise.
+
+    """
+    backend = env.subst("$PANDOCWATCHBACKEND") or "auto"
+    if backend not in ("auto", "inotify", "poll"):
+        raise SCons.Errors.UserError(
+                "Invalid PANDOCWATCHBACKEND '{0}'; expected 'auto', "
+                "'inotify', or 'poll'".format(backend)
+            )
+
+    if backend != "poll":
+        try:
+            return _Inotify()
+        except (AttributeError, OSError) as err:
+            if backend == "inotify":
+                raise SCons.Errors.StopError(
+                        "Could not use inotify: {0}".format(err)
+                    )
+
+    return _Poll(float(env.subst("$PANDOCWATCHINTERVAL") or 0.5))
+
+
+class _WatchTask(SCons.Taskmaster.OutOfDateTask):
+    """A task of :func:`_PandocWatch`
+
+    A failure is reported and the other targets are still built so the
+    next change can fix it.
+
+    """
+    def failed(self):
+        err = SCons.Errors.convert_to_BuildError(self.exc_info()[1])
+        sys.stderr.write("scons: *** [{0}] {1}\n".format(
+                err.node or self.targets[0], err
+            ))
+        self.fail_continue()
+        self.exc_clear()
+
+
+def _tree(nodes):
+    """Every Node the given Nodes depend on as last scanned
+
+    The images replaced by :func:`_derive` are included because a shared
+    derivative only depends on the first image with the same contents.
+
+    """
+    seen = {}
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+
+        seen[node] = True
+        # A source in a variant directory may be scanned in the source
+        # directory.
+        rfile = getattr(node, "rfile", None)
+        if rfile and rfile() is not node:
+            stack.append(rfile())
+
+        stack.extend(node.children(scan=0))
+        stack.extend(getattr(node.attributes, "pandoc_images",
+                             (None, [], []))[2])
+
+    return list(seen)
+
+
+def _forget(node):
+    """Clear what the scan of a target made so the next scan remakes it
+
+    The cited entries of :func:`_bibjson` and the image filter of
+    :func:`_derive` belong to the target and are made again with the
+    results of the new scan.
+
+    """
+    for name in ("pandoc_bibjson", "pandoc_images"):
+        made = getattr(node.attributes, name, None)
+        if made is None:
+            continue
+
+        delattr(node.attributes, name)
+        if made[0] is not None:
+            made[0].builder_set(None)
+            made[0].set_explicit(False)
+            made[0].sources = []
+            made[0].sources_set = set()
+
+
+def _watched(node):
+    """The paths of the source files a target depends on"""
+    return set(x.get_abspath() for x in _tree([node])
+               if isinstance(x, SCons.Node.FS.File) and not x.has_builder())
+
+
+def _rebuild(nodes, jobs):
+    """Clear the state of targets and build them again
+
+    This is what ``scons --interactive`` does to build in the same
+    process again.
+
+    Returns
+    -------
+
+    interrupted: bool
+        Whether the build was interrupted
+
+    """
+    tree = _tree(nodes)
+    for node in nodes:
+        _forget(node)
+
+    for node in tree:
+        node.clear()
+        node.set_state(SCons.Node.no_state)
+        node.implicit = None
+
+    taskmaster = SCons.Taskmaster.Taskmaster(nodes, _WatchTask)
+    jobs = _jobs.Jobs(jobs, taskmaster)
+    jobs.run(postfunc=SCons.SConsign.write)
+    for cache in _scan_caches.values():
+        cache.save()
+
+    return jobs.were_interrupted()
+
+
+def _PandocWatch(env, target=None):
+    """Rebuild Pandoc targets whenever their dependencies change
+
+    Nothing happens unless SCons was started with ``--pandoc-watch``.
+    The ``target`` defaults to every target of the ``Pandoc`` builder
+    defined so far.  The targets are built and then the files in their
+    dependency trees are watched.  The edits within ``$PANDOCWATCHDELAY``
+    seconds of each other are handled together and only the targets
+    depending on the changed files are scanned and built again.  The
+    scan results and the Nodes stay in memory between the builds.  SCons
+    exits when the watch is interrupted.
+
+    """
+    if not SCons.Script.GetOption("pandoc_watch"):
+        return
+
+    logger = logging.getLogger(__name__ + ".watch")
+    if target is None:
+        nodes = list(_documents)
+        del _documents[:]
+    else:
+        nodes = env.arg2nodes(target, env.fs.Entry)
+
+    # Like 'scons --interactive', the built Nodes keep what is needed to
+    # build them again.
+    SCons.Node.interactive = True
+    delay = float(env.subst("$PANDOCWATCHDELAY") or 0)
+    jobs = SCons.Script.GetOption("num_jobs") or 1
+    watcher = _watcher(env)
+    try:
+        changed = nodes
+        while not _rebuild(changed, jobs):
+            files = {}
+            for node in nodes:
+                for path in _watched(node):
+                    files.setdefault(path, []).append(node)
+
+            watcher.add(files)
+            sys.stdout.write("scons: watching {0} files of {1} targets\n"
+                             .format(len(files), len(nodes)))
+            sys.stdout.flush()
+            changed = []
+            while not changed:
+                paths = watcher.read()
+                while paths:
+                    more = watcher.read(delay)
+                    if not more:
+                        break
+
+                    paths.update(more)
+
+                logger.debug("changed: {0}".format(sorted(paths)))
+                changed = [x for x in nodes if any(
+                        x in files.get(y, ()) for y in paths
+                    )]
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+    SCons.Script.Exit(0)
+
+
+_command = SCons.Action.Action("$PANDOCCOM", "$PANDOCCOMSTR")
+
+
+def _rewrites(node):
+    """The cited entries, the image filter, and the output directory a
+    target is built with
+    """
+    return (getattr(node.attributes, "pandoc_bibjson", (None,))[0],
+            getattr(node.attributes, "pandoc_images", (None,))[0],
+            getattr(node.attributes, "pandoc_output", None))
+
+
+def _build_command(target, source, env):
+    """The command line that builds a target
+
+    The bibliographies replaced by :func:`_bibjson` when the target was
+    scanned are replaced by the cited entries, the filter of
+    :func:`_derive` is run last, and chunked HTML is written to the
+    directory of :func:`_emitter`.
+
+    Returns
+    -------
+
+    cmd: list
+        The arguments of the command
+    rewritten: bool
+        Whether the command differs from ``$PANDOCCOM``
+
+    """
+    cmd = shlex.split(env.subst("$PANDOCCOM", target=target, source=source))
+    refs, images, output = _rewrites(target[0])
+    if refs is None and images is None and output is None:
+        return cmd, False
+
+    options = _tokenize(cmd[1:])
+    replaced = (None, "--bibliography") if refs is not None else (None,)
+    flags = [y for x in options if x.name not in replaced for y in (
+            x.args if x.name != "--output" or output is None
+            else ("--output=" + output.path,)
+        )]
+    inputs = [x.value for x in options if x.name is None]
+    if "--" in cmd:
+        inputs.insert(0, "--")
+
+    if refs is not None:
+        flags.insert(0, "--bibliography=" + refs.path)
+
+    if images is not None:
+        flags.append("--lua-filter=" + images.path)
+
+    return cmd[:1] + flags + inputs, True
+
+
+def _server_build(target, source, env):
+    """Convert the document with the Pandoc server
+
+    Anything the server cannot do falls back to the command line.
+
+    """
+    logger = logging.getLogger(__name__ + ".server")
+    cmd, rewritten = _build_command(target, source, env)
+    request, output = _server_request(cmd[1:])
+    if request and output:
+        try:
+            text, messages = _server_convert(
+                    _server(env), request,
+                    float(env.subst("$PANDOCSCANTIMEOUT") or 0) or None
+                )
+        except (OSError, ValueError) as err:
+            logger.debug("failed: {0}".format(err))
+        else:
+            for message in messages:
+                sys.stderr.write("[{0}] {1}\n".format(
+                        message.get("verbosity", "WARNING"),
+                        message.get("message", message)
+                    ))
+
+            # Pandoc ends the output with a new line unless a template
+            # was used.
+            if not request.get("standalone") and not text.endswith("\n"):
+                text += "\n"
+
+            with open(output, "w", encoding="utf-8") as stream:
+                stream.write(text)
+
+            return 0
+
+    # The command was already shown by _server_string.
+    return _command_action(cmd, rewritten, target)(target, source, env,
+                                                   show=False)
+
+
+def _server_string(target, source, env):
+    return env.subst("$PANDOCCOMSTR", target=target, source=source) \
+        or env.subst("$PANDOCCOM", target=target, source=source)
+
+
+def _generator(source, target, env, for_signature):
+    """Select the action for the backend
+
+    The signature is always the command line so switching the backend
+    does not rebuild the documents.  With ``$PANDOCSIGNATURE`` set to
+    ``normalized`` it is the :func:`_signature` of the command line.
+
+    """
+    if not for_signature:
+        _check(env)
+
+    mode = env.subst("$PANDOCSIGNATURE") or "raw"
+    if mode not in ("raw", "normalized"):
+        raise SCons.Errors.UserError(
+                "Invalid PANDOCSIGNATURE '{0}'; expected 'raw' or "
+                "'normalized'".format(mode)
+            )
+
+    if for_signature and mode == "normalized":
+        # The name of the executable is enough so Pandoc is not looked
+        # up while the SConscript files are read.
+        if env.get("PANDOC") == _pandoc_default:
+            env = env.Override({"PANDOC": "pandoc"})
+
+        cmd, rewritten = _build_command(target, source, env)
+        signature = _signature(cmd)
+        if signature is not None:
+            return _SignatureAction([
+                    x.replace("$", "$$") for x in signature
+                ])
+
+        return _command_action(cmd, rewritten, target)
+
+    server = not for_signature and _server(env)
+    if not server and _rewrites(target[0]) == (None, None, None):
+        return _command
+
+    cmd, rewritten = _build_command(target, source, env)
+    if server:
+        request, output = _server_request(cmd[1:])
+        if request and output:
+            return SCons.Action.Action(_server_build, _server_string)
+
+    return _command_action(cmd, rewritten, target)
+
+
+class _SignatureAction(SCons.Action.CommandAction):
+    """The normalized signature of :func:`_generator`
+
+    The executable in the signature is only a name so the dependency on
+    Pandoc is taken from ``$PANDOCCOM``.
+
+    """
+    def __init__(self, signature):
+        super().__init__(signature)
+
+    def get_implicit_deps(self, target, source, env, executor=None):
+        return _command.get_implicit_deps(target, source, env, executor)
+
+
+def _command_action(cmd, rewritten, target):
+    """The command line action for :func:`_build_command`
+
+    Pandoc only writes chunked HTML to a new directory so the directory
+    is removed first.
+
+    """
+    if not rewritten:
+        return _command
+
+    action = [[x.replace("$", "$$") for x in cmd]]
+    output = _rewrites(target[0])[2]
+    if output is not None:
+        action.insert(0, SCons.Defaults.Delete(output.path))
+
+    return SCons.Action.Action(action, "$PANDOCCOMSTR")
+
+
+_builder = SCons.Builder.Builder(
+        generator=_generator,
+        target_scanner=SCons.Scanner.Scanner(_scanner),
+        target_factory=SCons.Node.FS.Entry,
+        emitter=_emitter,
+    )
+
+
+_options_added = False
+_pandoc_default = "${_pandoc_path(__env__)}"
+
+
+def generate(env):
+    """Add the Builders and construction variables to the Environment
+    """
+    command = "$PANDOC $PANDOCFLAGS -o ${TARGET} ${SOURCES}"
+    env.SetDefault(
+            # Pandoc is only looked for when it is needed.
+            PANDOC=_pandoc_default,
+
+            # Command line flags.
+            PANDOCFLAGS=SCons.Util.CLVar("--standalone"),
+
+            # Commands.
+            PANDOCCOM=command,
+            PANDOCCOMSTR="",
+            PANDOCASTCOM="$PANDOC ${_pandoc_reader_flags(PANDOCFLAGS)} "
+                         "--to json -o ${TARGET} ${SOURCES}",
+            PANDOCWRITECOM="$PANDOC ${_pandoc_writer_flags(PANDOCFLAGS)} "
+                           "--from json -o ${TARGET} ${SOURCES}",
+            PANDOCSTAGECOM="$PANDOC $PANDOCFLAGS --from json --to json "
+                           "-o ${TARGET} ${SOURCES}",
+            PANDOCFILTERCOMSTR="",
+            PANDOCASTSUFFIX=".ast.json",
+
+            # Backend.
+            PANDOCBACKEND="cli",
+            PANDOCSERVER="",
+            PANDOCSIGNATURE="raw",
+
+            # Scanning.
+            PANDOCPROFILE="",
+            PANDOCSCANCACHE="#.pandocscan.json",
+            PANDOCSCANCACHESIZE=4096,
+            PANDOCSCANSTORE="",
+            PANDOCSCANSTORESIZE=0,
+            PANDOCSCANJOBS=0,
+            PANDOCSCANMODE="full",
+            PANDOCSCANTIMEOUT=0,
+            PANDOCSCANENGINE="threads",
+            PANDOCSCANFAST="off",
+            PANDOCSCANNEUTRAL=[],
+            PANDOCFILTERDEPS={},
+
+            # Bibliographies.
+            PANDOCBIBJSON=False,
+            PANDOCBIBSUFFIX=".csl.json",
+            PANDOCBIBCOM="$PANDOC --to csljson -o $TARGET $SOURCE",
+            PANDOCBIBCOMSTR="",
+            PANDOCCITECOMSTR="",
+
+            # Images.
+            PANDOCIMAGES={},
+            PANDOCIMAGEDIR="#_images",
+            PANDOCIMAGEFILTERSUFFIX=".images.lua",
+            PANDOCIMAGEFILTERCOMSTR="",
+
+            # Watching.
+            PANDOCWATCHBACKEND="auto",
+            PANDOCWATCHDELAY=0.1,
+            PANDOCWATCHINTERVAL=0.5,
+
+        )
+    global _options_added
+    if not _options_added:
+        _options_added = True
+        options = (
+                ("--pandoc-profile", dict(
+                    dest="pandoc_profile", metavar="FILE", default="",
+                    help="Write the cost of the Pandoc scans to FILE"
+                )),
+                ("--pandoc-watch", dict(
+                    dest="pandoc_watch", action="store_true", default=False,
+                    help="Rebuild the targets of env.PandocWatch when "
+                    "their dependencies change"
+                )),
+            )
+        for name, kw in options:
+            try:
+                SCons.Script.AddOption(name, **kw)
+            except optparse.OptionConflictError:
+                pass
+
+    env["_pandoc_path"] = _pandoc_path
+    env["_pandoc_reader_flags"] = _reader_flags
+    env["_pandoc_writer_flags"] = _writer_flags
+    env["BUILDERS"]["Pandoc"] = _builder
+    env.AddMethod(_PandocMulti, "PandocMulti")
+    env.AddMethod(_PandocPrescan, "PandocPrescan")
+    env.AddMethod(_PandocStaged, "PandocStaged")
+    env.AddMethod(_PandocWatch, "PandocWatch")
+    return
+
+
+def exists(env):
+    """Check if Pandoc can be found without running it
+
+    The version is checked by :func:`_check` when the first document is
+    scanned or built.
+
+    """
+    if env.get("PANDOC") and env["PANDOC"] != _pandoc_default:
+        return env.subst("$PANDOC")
 
-    return pandoc
+    return _where(env)